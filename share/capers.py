@@ -26,8 +26,9 @@ COPYING for details on distribution and derivation.
 
 DISCLAIMER:
 
-- a game, for which there is no engine, cannot be played, as capers
-  does not know how to take pieces and crown kings.
+- a game, for which there is no engine, cannot be played: capers only
+  knows how to take pieces and crown kings in english and mafierz, to
+  replay the games of the book, not to play them on its own.
 
 - unlike earlier versions of capers, this one is made with a
   toolkit. the python bindings make working with gtk quite bearable.
@@ -46,10 +47,14 @@ DISCLAIMER:
 DEVEL:
 
 - drive: all but one action are triggerd from the gui, only the engines
-  moves are ticking in a gobject timeout loop.
+  moves come from gobject: the next engine is asked from idle, after a
+  move was made; it searches in a thread or in a worker process, and
+  gobject watches the pipe, that the info and the move come over.
 
-- locking: the Main.game.lock is held, when an engine moves, and when a
-  game is created, and while reading a pdn
+- locking: the Main.game.lock is held, while an engine searches, till
+  its move is made, and when a game is created, and while reading a
+  pdn; the pdn is read in a thread, the games are put into the book
+  from gobject idle
 
 
 TODO:
@@ -65,9 +70,6 @@ TODO:
 
 - intermediate hops mouse input (wait for python-gnomecanvas grab())
 
-- lazy loading of engines, so application starts faster - seems
-  no problem here, maybe will be with cake...
-
 - network play: with central server, or p2p  or both?
 
 """
@@ -86,24 +88,99 @@ import math
 # G A M E
 # =======
 
+from array import array
+import random
+
+class Layout(object):
+	"""the squares of a board: numbers and coordinates
+
+	- a layout is built once per gametype and shared by all positions
+	- nums and coors are immutable tuples, in the order of the squares
+	- index maps a number to its square, lookup maps (x, y) to a number
+	- zobrist has a random 64 bit key per square and piece, turn one for
+	  white to move; seeded with the gametype, they are the same in every
+	  session, so hashes can be kept on disk
+	"""
+
+	__slots__ = ('nums', 'coors', 'index', 'lookup', 'zobrist', 'turn')
+
+	def __init__(self, squares, seed):
+		"squares is a list of (num, x, y)"
+		self.nums = tuple([s[0] for s in squares])
+		self.coors = tuple([(s[1], s[2]) for s in squares])
+		self.index = {}
+		self.lookup = {}
+		for i in xrange(len(squares)):
+			num, x, y = squares[i]
+			if num:
+				self.index[num] = i
+			self.lookup[(x, y)] = num
+		# empty and free squares hash to 0
+		rand = random.Random(seed)
+		pieces = (Position.WHITE|Position.MAN, Position.BLACK|Position.MAN,
+			Position.WHITE|Position.KING, Position.BLACK|Position.KING)
+		self.zobrist = []
+		for i in xrange(len(squares)):
+			keys = [0] * (Position.FREE + 1)
+			for piece in pieces:
+				keys[piece] = rand.getrandbits(64)
+			self.zobrist.append(tuple(keys))
+		self.zobrist = tuple(self.zobrist)
+		self.turn = rand.getrandbits(64)
+
+class Squares(object):
+	"""a position: the values of the squares in a byte array
+
+	the layout is shared by reference, so a copy of a position is just
+	a copy of its buffer; pieces on the canvas are not kept here, the
+	board maps square numbers to pieces itself
+
+	the zobrist hash of the pieces is kept up to date by set, so the
+	values must not be changed directly
+	"""
+
+	__slots__ = ('layout', 'values', 'hash')
+
+	def __init__(self, layout, values, hash=None):
+		self.layout = layout
+		self.values = values
+		if hash is None:
+			hash = 0
+			zobrist = layout.zobrist
+			for i in xrange(len(values)):
+				hash ^= zobrist[i][values[i]]
+		self.hash = hash
+
+	def __len__(self):
+		return len(self.values)
+
+	def copy(self):
+		"return copy of position: values by value, layout by reference"
+		return Squares(self.layout, self.values[:], self.hash)
+
+	def set(self, i, value):
+		"set square <i> to <value>, update the hash"
+		keys = self.layout.zobrist[i]
+		self.hash ^= keys[self.values[i]] ^ keys[value]
+		self.values[i] = value
+
+	def key(self, color):
+		"return the hash of the position with <color> to move"
+		if color == Position.WHITE:
+			return self.hash ^ self.layout.turn
+		return self.hash
+
 class Position:
 	"""known setup positions:
 	international, english, (italian, russian,) mafierz
 
-	in store: pseudo constants for the values of a square, a function
-	to return a mutable deepcopy of a position, with references to
-	pixmaps intact, and a function to print an ascii art board
+	in store: pseudo constants for the values of a square, the shared
+	layouts of the gametypes and a function to print an ascii art board
 
-	- a position is a list of squares: 64 or 100 are allowed
-	- a square is a list of five values: num, col, x, y, pixbuf
+	- a position is a Squares object: 64 or 100 squares are allowed
+	- a square has a value in the position, num, x, y in the layout
 	"""
 
-	COL_NUM = 0
-	COL_VAL = 1
-	COL_X = 2
-	COL_Y = 3
-	COL_PIECE = 4 # pixbuf reference
-
 	# square values
 	EMPTY = 0
 	WHITE = 1
@@ -113,16 +190,17 @@ class Position:
 	KING = 8
 	FREE = 16
 
+	_layouts = {} # gametype: layout
+
 	# convenience
-	def copy(self, position):
-		"""return mutable deepcopy of position:
-		simple types by value, objects by reference"""
-		temp = []
-		for i in xrange(len(position)):
-			temp.append([0]*len(position[i]))
-			for j in xrange(len(position[i])):
-				temp[i][j] = position[i][j]
-		return temp
+	def squares(self, gametype, setup):
+		"""return position from <setup>, a list of (num, val, x, y)
+		the layout is only built on the first call for a gametype"""
+		layout = self._layouts.get(gametype)
+		if not layout:
+			layout = Layout([(s[0], s[2], s[3]) for s in setup], gametype)
+			self._layouts[gametype] = layout
+		return Squares(layout, array('B', [s[1] for s in setup]))
 
 	def ascii(self, position):
 		"return ascii art string of <position>"
@@ -132,9 +210,9 @@ class Position:
 		if len(position) == 64: c = 8
 		if len(position) == 100: c = 10
 		assert c
-		for s in position:
+		for v in position.values:
 			i += 1
-			r = r + squares[s[1]] + ' '
+			r = r + squares[v] + ' '
 			if i % c == 0: r = r + "\n  "
 		return r
 
@@ -146,15 +224,10 @@ class Position:
 			fpos[num] = val
 		for num, val in wpos.iteritems():
 			fpos[num] = val
-		for s in position:
-			if not s[self.COL_NUM]:
-				continue
-			s[self.COL_VAL] = self.EMPTY
-			try:
-				newval = fpos[s[self.COL_NUM]]
-				s[self.COL_VAL] = newval
-			except KeyError:
+		for i, num in enumerate(position.layout.nums):
+			if not num:
 				continue
+			position.set(i, fpos.get(num, self.EMPTY))
 		return turn, position
 
 	# setup positions
@@ -169,20 +242,20 @@ class Position:
 					if count < 39:
 						pos.append((count / 2 + 1,
 							self.WHITE|self.MAN,
-							row, col, 0))
+							row, col))
 					elif count > 59:
 						pos.append((count / 2 + 1,
 							self.BLACK|self.MAN,
-							row, col, 0))
+							row, col))
 					else:
 						pos.append((count / 2 + 1,
 							self.EMPTY,
-							row, col, 0))
+							row, col))
 				else:
 					pos.append((0, self.FREE,
-						row, col, 0))
+						row, col))
 				count += 1
-		return (self.WHITE, self.copy(pos))
+		return (self.WHITE, self.squares(Game.INTERNL, pos))
 
 	def english(self):
 		"return english setup, color to move first"
@@ -196,23 +269,23 @@ class Position:
 						pos.append((count / 2 + 1,
 							self.BLACK|self.MAN,
 							cells - row - 1,
-							cells - col - 1, 0))
+							cells - col - 1))
 					elif count > 39:
 						pos.append((count / 2 + 1,
 							self.WHITE|self.MAN,
 							cells - row - 1,
-							cells - col - 1, 0))
+							cells - col - 1))
 					else:
 						pos.append((count / 2 + 1,
 							self.EMPTY,
 							cells - row - 1,
-							cells - col - 1, 0))
+							cells - col - 1))
 				else:
 					pos.append((0, self.FREE,
 						cells - row - 1,
-						cells - col - 1, 0))
+						cells - col - 1))
 				count += 1
-		return (self.BLACK, self.copy(pos))
+		return (self.BLACK, self.squares(Game.ENGLISH, pos))
 
 	def italian(self):
 		"return italian setup, color to move first"
@@ -235,23 +308,23 @@ class Position:
 						pos.append((count / 2 + 1,
 							self.BLACK|self.MAN,
 							cells - row - 1,
-							col, 0))
+							col))
 					elif count > 40:
 						pos.append((count / 2 + 1,
 							self.WHITE|self.MAN,
 							cells - row - 1,
-							col, 0))
+							col))
 					else:
 						pos.append((count / 2 + 1,
 							self.EMPTY,
 							cells - row - 1,
-							col, 0))
+							col))
 				else:
 					pos.append((0, self.FREE,
 						cells - row - 1,
-						col, 0))
+						col))
 				count += 1
-		return (self.WHITE, self.copy(pos))
+		return (self.WHITE, self.squares(Game.MAFIERZ, pos))
 
 class Game:
 	"""glue together gui, engine, board and book
@@ -265,8 +338,8 @@ class Game:
 	having to ask the book
 
 	on selecting an old game, a new setup position is created and the game
-	rewound, in order to update all the pixbuf references to valid ones;
-	a game loaded from pdn is just like a game from the treestore
+	rewound, in order to fill in the positions of all the moves; a game
+	loaded from pdn is just like a game from the treestore
 
 	all communication with board and book shall be through the game
 	the game also keeps the lock, while an engine is searching a move
@@ -290,7 +363,8 @@ class Game:
 	_game_curr = _game_last = _move_curr = _move_last = -1
 	_position = []
 	_black = _white = _grey = False
-	engines_loop = 0
+	engines_on = False
+	_engines_next = 0 # gobject source of engine_getmove
 
 	def __init__(self):
 		self.lock = thread.allocate_lock()
@@ -398,14 +472,34 @@ class Game:
 			and self._black and not self._white:
 			flip = True
 		Main.board.new(self.gametype, self._position, flip)
-		movelist = Main.book.old_game(self._position)
+		movelist = Main.book.old_game(self._position, self._color)
+		if Main.book.replays.replayed(self._game_curr,
+			self.replay_key(fen, movelist)):
+			# the moves in the book are as the replay left them
+			self._move_curr = len(movelist) - 1
+			self._move_last = self._move_curr
+			self.lock.release()
+			self.engines_next()
+			self.goto_begin()
+			return
+		# no need to bother the engine with the known rules
+		if Main.rules.knows(self.gametype):
+			islegal = Main.rules.islegal
+		else:
+			islegal = self._grey.islegal
 		for move in movelist:
-			data = self._grey.islegal(move,
-				self._color, self._position, None)
+			data = islegal(move, self._color, self._position, None)
 			self.do_oldmove(move, data)
+		Main.book.replays.put(self._game_curr,
+			self.replay_key(fen, Main.book.get_movelist()))
 		self.lock.release()
+		self.engines_next()
 		self.goto_begin()
 
+	def replay_key(self, fen, movelist):
+		"return the hash, by which replays knows a game"
+		return hash((self.gametype, repr(fen), tuple(map(tuple, movelist))))
+
 	def pdn(self, last):
 		"go to the first game in the book, that has num <last> games"
 		assert not self.lock.locked()
@@ -413,6 +507,10 @@ class Game:
 		self._game_last = last
 		self.old(0)
 
+	def loaded(self, last):
+		"the book loads on, it has num <last> games now"
+		self._game_last = last
+
 	# editor
 	def start_edit(self, empty=False):
 		"start new game from current setup or empty board, lock game"
@@ -425,6 +523,8 @@ class Game:
 		if isinstance(self._white, Engine):
 			whitename = self._white.name
 		name = False
+		# the book may keep the position, edit a copy
+		self._position = self._position.copy()
 		self._game_curr, = Main.book.new_game(name, self.gametype,
 			blackname, whitename, self._position, self._color)
 		# setup board
@@ -441,9 +541,8 @@ class Game:
 		"create fen of current position, correct book, release game lock"
 		bpos = {}
 		wpos = {}
-		for s in self._position:
-			num = s[Position.COL_NUM]
-			val = s[Position.COL_VAL]
+		for num, val in zip(self._position.layout.nums,
+			self._position.values):
 			if val & Position.BLACK:
 				bpos[num] = val
 			if val & Position.WHITE:
@@ -451,12 +550,17 @@ class Game:
 		Main.book[self._game_curr][Book.COL_HEAD]['fen'] = \
 			self._color, bpos, wpos
 		Main.book[self._game_curr][Book.COL_POS] = self._position
+		Main.book[self._game_curr][Book.COL_HASH] = \
+			self._position.key(self._color)
+		Main.book.positions.add(self._position.key(self._color),
+			self._game_curr, -1)
 		Main.feedback.g_push('Setup registered')
 		if self._color == Position.WHITE:
 			Main.feedback.g_push('Position set: White to move')
 		else:
 			Main.feedback.g_push('Position set: Black to move')
 		self.lock.release()
+		self.engines_next()
 
 	# transport
 	def goto_move(self, move):
@@ -499,6 +603,8 @@ class Game:
 		"go to move/position <game> in current game"
 		if self.lock.locked():
 			return
+		if game > self._game_last:
+			self.page_in()
 		game = min(self._game_last, game)
 		game = max(game, 0)
 		if game == self._game_curr:
@@ -506,13 +612,49 @@ class Game:
 		self.engines_stop()
 		self.old(game)
 
+	def page_in(self):
+		"put the next page of games of a database into the book"
+		if self.lock.locked():
+			return
+		if Main.book.page_in():
+			self._game_last = Main.book.iter_n_children(None) - 1
+
 	def goto_game_prev(self):
-		"go to the previous game"
-		self.goto_game(self._game_curr - 1)
+		"go to the previous game, that the search shows"
+		self.goto_game(Main.book.next_shown(self._game_curr, -1))
 
 	def goto_game_next(self):
-		"go to the next game"
-		self.goto_game(self._game_curr + 1)
+		"go to the next game, that the search shows"
+		self.goto_game(Main.book.next_shown(self._game_curr, 1))
+
+	def find_position(self):
+		"go to the next game or move in the book with the current position"
+		if self.lock.locked():
+			return
+		hits = Main.book.find_position(self._position.key(self._color))
+		current = (self._game_curr, self._move_curr)
+		if not [hit for hit in hits if hit != current]:
+			Main.feedback.g_push('Position not found elsewhere in the book')
+			return
+		game, move = ([hit for hit in hits if hit > current] or hits)[0]
+		self.goto_game(game)
+		self.goto_move(move)
+		Main.feedback.g_push('Position found %d of %d times: game %d'
+			%(hits.index((game, move)) + 1, len(hits), game + 1))
+
+	def explore(self):
+		"tell the replies played in the book here, and how they scored"
+		Main.book.index_pending()
+		tally, replies = \
+			Main.book.openings.explore(self._position.key(self._color))
+		if not tally:
+			Main.feedback.g_push('Position not in the openings of the book')
+			return
+		# games, 1-0, 0-1, draws
+		text = ['%d games, 1-0/0-1/draw: %d/%d/%d' % tuple(tally)]
+		for name, hash, reply in replies[:6]:
+			text.append('%s %d: %d/%d/%d' % ((name,) + tuple(reply)))
+		Main.feedback.g_push(', '.join(text))
 
 	def goto_game_move(self, path):
 		"""go to move/position <path> in game <path>
@@ -529,75 +671,72 @@ class Game:
 
 	# convenience
 	def num2val(self, num):
-		"return value of square <num>"
-		for s in self._position:
-			if s[Position.COL_NUM] == num:
-				return s[Position.COL_VAL]
-		assert "number off board"
-
-	def num2piece(self, num):
-		"return piece on square <num>"
-		for s in self._position:
-			if s[Position.COL_NUM] == num:
-				return s[Position.COL_PIECE]
-		assert "number off board"
+		"return value of square <num>, None if off board"
+		i = self._position.layout.index.get(num)
+		if i is not None:
+			return self._position.values[i]
 
 	def num2coor(self, num):
-		"translate number to coordinates"
-		for s in self._position:
-			if s[Position.COL_NUM] == num:
-				return (s[Position.COL_X], s[Position.COL_Y])
-		assert "number off board"
+		"translate number to coordinates, None if off board"
+		layout = self._position.layout
+		i = layout.index.get(num)
+		if i is not None:
+			return layout.coors[i]
 
 	def coor2num(self, x, y):
-		"translate coordinates to number"
-		for s in self._position:
-			if s[Position.COL_X] == x  \
-				and s[Position.COL_Y] == y:
-				return s[Position.COL_NUM]
-		assert "coordinates off board"
+		"translate coordinates to number, 0 if off board or unused"
+		return self._position.layout.lookup.get((x, y), 0)
 
 	# calls to engine
 	def engines_stop(self):
-		"make engine_getmove always return False"
-		if self.engines_loop:
-			gobject.source_remove(self.engines_loop)
-			self.engines_loop = 0
+		"make engine_getmove return at once, tell searching engines to play now"
+		if self.engines_on:
+			self.engines_on = False
+			for engine in (self._black, self._white):
+				if isinstance(engine, Engine):
+					engine.stop()
 			Main.feedback.g_push('Engines stop')
 
 	def engines_go(self):
-		"let engine_getmove return True"
-		if self.engines_loop:
-			return
-		self.engines_loop = \
-			gobject.timeout_add(self._timeout, self.engine_getmove)
-		Main.feedback.g_push('Engines go')
+		"let engine_getmove ask the engines"
+		if not self.engines_on:
+			self.engines_on = True
+			Main.feedback.g_push('Engines go')
+		self.engines_next()
+
+	def engines_next(self):
+		"have engine_getmove ask the engine, as soon as gtk is idle"
+		if self.engines_on and not self._engines_next:
+			self._engines_next = gobject.idle_add(self.engine_getmove)
 
 	def engine_getmove(self):
-		"""ask the engine for a move, called from gobject timeout, so its
-		in a loop, where False means break, and True means continue, but
-		this will never break what is not broken, only engines_stop does"""
-		if not self.engines_loop:
+		"""ask the engine for a move, called from gobject idle, when the
+		engines go, a move was made or the game lock released; while the
+		user drags a piece, try again after timeout; always return False"""
+		self._engines_next = 0
+		if not self.engines_on:
 			return False
 		if self.lock.locked():
-			return True
+			return False
 		if Main.board.busy:
-			return True
+			self._engines_next = \
+				gobject.timeout_add(self._timeout, self.engine_getmove)
+			return False
 		if self._color == Position.WHITE \
 			and not isinstance(self._white, Engine):
-			return True
+			return False
 		if self._color == Position.BLACK \
 			and not isinstance(self._black, Engine):
-			return True
+			return False
 
 		maxtime = Main.prefs.getint('engines', 'maxtime')
 		data = [self._color, maxtime, self._position]
 		if self._color == Position.WHITE:
 			self._white.getmove(data)
-			return True
+			return False
 		if self._color == Position.BLACK:
 			self._black.getmove(data)
-			return True
+			return False
 		assert 0
 
 	def engine_islegal(self, list):
@@ -614,27 +753,29 @@ class Game:
 		return [False]
 
 	# book management
-	def save_move(self, steps, jumps):
-		"register move with book"
+	def save_move(self, steps, huffs, new):
+		"register move with book: steps, captured squares, new piece"
+		Main.book.replays.drop(self._game_curr)
 		if self._move_curr < self._move_last:
 			Main.book.trunc_game(self._move_curr)
 		# name = move as string
-		if jumps:
+		if huffs:
 			name = 'x'.join([`num` for num in steps])
 		else:
 			name = '-'.join([`num` for num in steps])
 		self._game_curr, self._move_curr = Main.book.new_move(name,
-			self._position, self._color, steps)
+			self._position, self._color, steps, huffs, new)
 		self._move_last = self._move_curr
 
-	def save_oldmove(self, steps, jumps):
+	def save_oldmove(self, steps, huffs, new):
 		"reregister move with book, increments move_curr"
-		if jumps:
+		if huffs:
 			name = 'x'.join([`num` for num in steps])
 		else:
 			name = '-'.join([`num` for num in steps])
 		self._game_curr, self._move_curr = Main.book.old_move(
-			self._move_curr, name, self._position, self._color, steps)
+			self._move_curr, name, self._position, self._color, steps,
+			huffs, new)
 		self._move_last = self._move_curr
 
 	def set_result(self, code, move):
@@ -670,42 +811,27 @@ class Game:
 	# board management
 	def empty(self):
 		"clear board of all pieces, needed for edit empty"
-		for s in self._position:
-			s[Position.COL_VAL] = Position.EMPTY
-			p = s[Position.COL_PIECE]
-			if p:
-				p.destroy()
-			s[Position.COL_PIECE] = 0
+		values = self._position.values
+		for i in xrange(len(values)):
+			values[i] = Position.EMPTY
+		self._position.hash = 0
+		Main.board.clear_pieces()
 
 	def clean(self):
 		"clear board of all hidden pieces, needed for edit"
-		for s in self._position:
-			p = s[Position.COL_PIECE]
-			v = s[Position.COL_VAL]
-			if p and not v:
-				p.destroy()
-				s[Position.COL_PIECE] = 0
+		Main.board.clean_pieces()
 
 	def do_move_silent(self, a, b):
 		"update temp position after move, reducable"
 		if a == b: return b
-		n = m = -1 # from, to
 		# find squares a, b
-		for s in self._position:
-			if s[Position.COL_NUM] == a:
-				n = self._position.index(s)
-			elif s[Position.COL_NUM] == b:
-				m = self._position.index(s)
-		assert n >= 0 and m >=0
+		position = self._position
+		index = position.layout.index
+		n, m = index[a], index[b] # from, to
 		# swap values 1, 4
-		self._position[m][Position.COL_VAL], \
-			self._position[n][Position.COL_VAL] \
-			= self._position[n][Position.COL_VAL], \
-				self._position[m][Position.COL_VAL]
-		self._position[m][Position.COL_PIECE], \
-			self._position[n][Position.COL_PIECE] \
-			= self._position[n][Position.COL_PIECE], \
-				self._position[m][Position.COL_PIECE]
+		value = position.values[n]
+		position.set(n, position.values[m])
+		position.set(m, value)
 		return b
 
 	def do_move(self, a, b):
@@ -715,35 +841,29 @@ class Game:
 
 	def take_piece(self, num):
 		"take piece on squares num in list, called via map()"
-		for s in self._position:
-			if s[Position.COL_NUM] != num: continue
-			assert s[Position.COL_PIECE]
-			s[Position.COL_VAL] = Position.EMPTY
-			Main.board.take_piece(num)
-			break
+		self.take_piece_silent(num)
+		Main.board.take_piece(num)
 
 	def take_piece_silent(self, num):
 		"take piece on squares num in list, called via map()"
-		for s in self._position:
-			if s[Position.COL_NUM] != num: continue
-			assert s[Position.COL_PIECE]
-			s[Position.COL_VAL] = Position.EMPTY
-			break
+		i = self._position.layout.index.get(num)
+		if i is None:
+			return
+		assert self._position.values[i]
+		self._position.set(i, Position.EMPTY)
 
 	def promote(self, num, value, silent=False):
 		"update temp position with piece value"
-		for s in self._position:
-			if s[Position.COL_NUM] != num: continue
-			if not Main.board.edit:
-				assert s[Position.COL_PIECE]
-			s[Position.COL_VAL] = value
-			if not silent:
-				s[Position.COL_PIECE] = Main.board.set_piece(num, value)
-			break
+		i = self._position.layout.index.get(num)
+		if i is None:
+			return
+		self._position.set(i, value)
+		if not silent:
+			Main.board.set_piece(num, value)
 
 	def do_enginemove(self, data):
-		"""register legal engine move with current position, release game lock
-		always return False to remove gobject idle"""
+		"""register legal engine move with current position, release game lock,
+		let the next engine go; always return False"""
 		code, steps, new, old, huffs, lock = data
 		if code != Engine.UNKNOWN:
 			if len(huffs):
@@ -754,31 +874,40 @@ class Game:
 			lock.release()
 			# dont use this move
 			return False
-		self._position = Main.pos.copy(self._position)
+		self._position = self._position.copy()
 		reduce(self.do_move, steps)
 		map(self.take_piece, huffs)
 		if new != old:
 			self.promote(steps[-1], new)
 		self._color ^= Position.CC
-		self.save_move(steps, len(huffs))
+		self.save_move(steps, huffs, new)
 		lock.release()
 		if self._color == Position.WHITE:
 			Main.feedback.g_push('White to move')
 		else:
 			Main.feedback.g_push('Black to move')
+		self.engines_next()
+		return False
+
+	def engine_failed(self, lock, message):
+		"""an engine did not return a move: stop the engines, release
+		game lock; always return False"""
+		self.engines_stop()
+		lock.release()
+		Main.feedback.g_push(message)
 		return False
 
 	def do_usermove(self, steps, data):
 		"register legal user move with current position, called from board"
 		assert data[0] # must be legal
 		code, steps, new, old, huffs = data
-		self._position = Main.pos.copy(self._position)
+		self._position = self._position.copy()
 		reduce(self.do_move_silent, steps)
 		map(self.take_piece, huffs)
 		if new != old:
 			self.promote(steps[-1], new)
 		self._color ^= Position.CC
-		self.save_move(steps, len(huffs))
+		self.save_move(steps, huffs, new)
 		if self._color == Position.WHITE:
 			Main.feedback.g_push('White to move')
 		else:
@@ -788,24 +917,504 @@ class Game:
 	def do_oldmove(self, steps, data):
 		"register legal old move with current position, called from replay"
 		if not data[0]: # must be legal
-			self.save_oldmove((0, 0), 0)
+			self.save_oldmove((0, 0), (), 0)
 			return
 		code, steps, new, old, huffs = data
-		self._position = Main.pos.copy(self._position)
+		self._position = self._position.copy()
 		reduce(self.do_move_silent, steps)
 		map(self.take_piece_silent, huffs)
 		# make kings
 		if new != old:
 			self.promote(steps[-1], new, True)
 		self._color ^= Position.CC
-		self.save_oldmove(steps, len(huffs))
+		self.save_oldmove(steps, huffs, new)
+
+class Rules:
+	"""a move generator for english and mafierz, on bitboards
+
+	replaying an old game needs every move checked, asking the engine
+	means filling a CBapi board for every single move, so the rules for
+	the 8x8 gametypes are known here as well; islegal works just like
+	the one of the engines
+
+	- a position is three 32 bit masks: black, white and kings, like
+	  cake's struct pos; square number n is bit n - 1
+	- the neighbours of the squares are derived from the layout of the
+	  gametype, once; men of black move towards the higher numbers
+	- mafierz adds the italian rules: men cannot take kings, and the
+	  capture taking most pieces, with a king, most kings and kings
+	  first, is the one to make
+	"""
+
+	gametypes = (Game.ENGLISH, Game.MAFIERZ)
+	_geometry = {} # gametype: geometry
+
+	class Geometry:
+		"neighbours and crowning rows of the squares of a layout"
+
+		def __init__(self, layout):
+			"walk the four diagonals of each square"
+			self.size = len(layout.index)
+			self.full = (1 << self.size) - 1
+			self.squares = [layout.index[n + 1] for n in xrange(self.size)]
+			self.bits = dict([(1 << i, i) for i in xrange(self.size)])
+			self.step = []
+			self.jump = []
+			down = 0
+			for dx, dy in ((-1, -1), (1, -1), (-1, 1), (1, 1)):
+				step = [-1] * self.size
+				jump = [-1] * self.size
+				for i in xrange(self.size):
+					x, y = layout.coors[self.squares[i]]
+					step[i] = layout.lookup.get((x + dx, y + dy), 0) - 1
+					jump[i] = layout.lookup.get((x + 2 * dx, y + 2 * dy), 0) - 1
+					if step[i] > i:
+						down = dy
+				self.step.append(step)
+				self.jump.append(jump)
+			dirs = ((-1, -1), (1, -1), (-1, 1), (1, 1))
+			self.dirs = range(4)
+			self.black_dirs = [d for d in self.dirs if dirs[d][1] == down]
+			self.white_dirs = [d for d in self.dirs if dirs[d][1] != down]
+			self.black_crown = self.crown(self.black_dirs)
+			self.white_crown = self.crown(self.white_dirs)
+
+		def crown(self, dirs):
+			"return mask of the squares, from where men cannot move on"
+			mask = 0
+			for i in xrange(self.size):
+				for d in dirs:
+					if self.step[d][i] >= 0:
+						break
+				else:
+					mask |= 1 << i
+			return mask
+
+	def knows(self, gametype):
+		"return True, if the rules of <gametype> are known"
+		return gametype in self.gametypes
+
+	def geometry(self, position, gametype):
+		"return geometry of <gametype>, build it on first use"
+		geo = self._geometry.get(gametype)
+		if not geo:
+			geo = self.Geometry(position.layout)
+			self._geometry[gametype] = geo
+		return geo
+
+	def masks(self, geo, position):
+		"return the bitboards black, white, kings of <position>"
+		black = white = kings = 0
+		values = position.values
+		for i in xrange(geo.size):
+			v = values[geo.squares[i]]
+			if not v:
+				continue
+			if v & Position.BLACK:
+				black |= 1 << i
+			elif v & Position.WHITE:
+				white |= 1 << i
+			if v & Position.KING:
+				kings |= 1 << i
+		return black, white, kings
+
+	def jumps(self, geo, i, dirs, king, opp, free, crown, italian, kings,
+		steps, huffs, moves):
+		"append all capture sequences of the piece on <i> to <moves>"
+		found = False
+		for d in dirs:
+			k = geo.jump[d][i]
+			if k < 0:
+				continue
+			j = geo.step[d][i]
+			over = 1 << j
+			if not opp & over or not free & (1 << k):
+				continue
+			if italian and not king and kings & over:
+				continue
+			found = True
+			# crowning ends the move
+			if not king and (1 << k) & crown:
+				moves.append((steps + [k], huffs + [j], True))
+				continue
+			self.jumps(geo, k, dirs, king, opp ^ over, free, crown, italian,
+				kings, steps + [k], huffs + [j], moves)
+		if not found and huffs:
+			moves.append((steps, huffs, False))
+
+	def italian(self, moves, kings):
+		"keep only the captures the italian rules allow"
+		def pick(moves, key):
+			best = max([key(m) for m in moves])
+			return [m for m in moves if key(m) == best]
+		moves = pick(moves, lambda m: len(m[1]))
+		moves = pick(moves, lambda m: m[3])
+		moves = pick(moves, lambda m: len([h for h in m[1] if kings & 1 << h]))
+		moves = pick(moves, lambda m: [-h for h in xrange(len(m[1]))
+			if kings & 1 << m[1][h]])
+		return moves
+
+	def movelist(self, geo, black, white, kings, color, italian):
+		"return legal moves: steps, huffs, crowned; captures are a must"
+		if color == Position.BLACK:
+			own, opp = black, white
+			fwd, crown = geo.black_dirs, geo.black_crown
+		else:
+			own, opp = white, black
+			fwd, crown = geo.white_dirs, geo.white_crown
+		free = geo.full & ~(black | white)
+		moves = []
+		pieces = own
+		while pieces:
+			bit = pieces & -pieces
+			pieces ^= bit
+			king = kings & bit
+			dirs = king and geo.dirs or fwd
+			found = []
+			self.jumps(geo, geo.bits[bit], dirs, king, opp, free | bit,
+				crown, italian, kings, [geo.bits[bit]], [], found)
+			moves.extend([m + (bool(king),) for m in found])
+		if moves:
+			if italian:
+				moves = self.italian(moves, kings)
+			return [m[:3] for m in moves]
+		pieces = own
+		while pieces:
+			bit = pieces & -pieces
+			pieces ^= bit
+			king = kings & bit
+			i = geo.bits[bit]
+			for d in king and geo.dirs or fwd:
+				j = geo.step[d][i]
+				if j >= 0 and free & (1 << j):
+					moves.append(([i, j], [],
+						not king and bool((1 << j) & crown)))
+		return moves
+
+	def islegal(self, list, color, position, cbmove, gametype=None):
+		"""check move in list, return False if illegal, else return list
+		same as Engine.islegal: [res, steps, new, old, huffs]; without
+		<gametype>, the one of the current game"""
+		gametype = gametype or Main.game.gametype
+		geo = self.geometry(position, gametype)
+		black, white, kings = self.masks(geo, position)
+		italian = gametype == Game.MAFIERZ
+		mfrom, mto = list[0] - 1, list[-1] - 1
+		found = None
+		for steps, huffs, crowned in self.movelist(geo,
+			black, white, kings, color, italian):
+			if steps[0] != mfrom or steps[-1] != mto:
+				continue
+			if not found or [s + 1 for s in steps] == list:
+				found = steps, huffs, crowned
+		if not found:
+			return [0, [], 0, 0, []]
+		steps, huffs, crowned = found
+		old = position.values[geo.squares[mfrom]]
+		new = old
+		if crowned:
+			new = color | Position.KING
+		return [1, [s + 1 for s in steps], new, old, [h + 1 for h in huffs]]
+
+	def replay(self, gametype, color, position, movelist):
+		"""return the hashes of <position> and of the positions after the
+		moves in <movelist>, up to the first illegal; <position> changes"""
+		index = position.layout.index
+		hashes = [position.key(color)]
+		for move in movelist:
+			res, steps, new, old, huffs = \
+				self.islegal(move, color, position, None, gametype)
+			if not res:
+				break
+			position.set(index[steps[0]], Position.EMPTY)
+			position.set(index[steps[-1]], new)
+			for num in huffs:
+				position.set(index[num], Position.EMPTY)
+			color ^= Position.CC
+			hashes.append(position.key(color))
+		return hashes
+
 
+from collections import OrderedDict, deque
+
+class Replays(object):
+	"""the games replayed last
+
+	replaying a game asks the rules or the engine about every move, and
+	writes what they said to the moves in the book; only which games
+	were replayed is kept here, by a hash of gametype, fen and the
+	movelist as the replay left it. the next time such a game is
+	selected, the moves in the book are known to be checked, the game
+	goes to its start, as after a replay, without asking again
+
+	only the <size> games used last are kept; a game, that gets a new
+	move, is dropped at once, all are, when the book is cleared
+	"""
+
+	size = 64
+
+	def __init__(self):
+		self.games = OrderedDict() # game: key
+
+	def replayed(self, game, key):
+		"return True, if <game> was replayed, and did not change since"
+		entry = self.games.pop(game, None)
+		if entry != key:
+			return False
+		self.games[game] = entry
+		return True
+
+	def put(self, game, key):
+		"keep <game> as replayed, drop the one used longest ago"
+		self.games.pop(game, None)
+		self.games[game] = key
+		if len(self.games) > self.size:
+			self.games.popitem(False)
+
+	def drop(self, game):
+		"forget <game>, it changed"
+		self.games.pop(game, None)
+
+	def clear(self):
+		"forget all games, the book is cleared"
+		self.games.clear()
 
 # =======
 # B O O K
 # =======
 
 import datetime
+from bisect import bisect_left, bisect_right
+
+class Positions(object):
+	"""an index of the positions in the book: hash to games and plies
+
+	the hashes are added, as the pdn parser or a replay, new moves and
+	the editor come up with them; the entries are only hints, the book
+	row must still have the hash, when it is found, as moves may have
+	been deleted or changed since
+
+	an entry is game << 12 | ply + 1, hashes seen once keep just that,
+	the others an array; plies past <plies> are not indexed, they would
+	run into the game
+	"""
+
+	plies = 4094 # the last ply, that fits into an entry
+
+	def __init__(self):
+		self.hashes = {}
+
+	def clear(self):
+		"forget all positions"
+		self.hashes = {}
+
+	def add(self, hash, game, ply):
+		"add position <hash> after move <ply> in <game>, -1 is the setup"
+		if ply > self.plies:
+			return
+		entry = game << 12 | ply + 1
+		found = self.hashes.get(hash)
+		if found is None:
+			self.hashes[hash] = entry
+		elif isinstance(found, array):
+			found.append(entry)
+		else:
+			self.hashes[hash] = array('L', (found, entry))
+
+	def find(self, hash):
+		"return the games and plies, where <hash> was seen"
+		found = self.hashes.get(hash)
+		if found is None:
+			return []
+		if not isinstance(found, array):
+			found = (found,)
+		return [(entry >> 12, (entry & 4095) - 1) for entry in found]
+
+class Openings(object):
+	"""an opening tree of the book: the positions of the first <depth>
+	plies of the games, merged by hash, so transpositions meet
+
+	each position counts the games that reached it, each reply the games
+	that played it there, both with their results: 1-0, 0-1 and draws;
+	games are added as their hashes become known, the book is never
+	scanned again
+	"""
+
+	depth = 40 # plies
+	results = {'1-0': 1, '0-1': 2, '1/2-1/2': 3, '1/2 1/2': 3}
+
+	def __init__(self):
+		self.clear()
+
+	def clear(self):
+		"forget all games"
+		self.positions = {} # hash: [games, 1-0, 0-1, draws]
+		self.replies = {} # hash: {move: [hash, games, 1-0, 0-1, draws]}
+
+	def add(self, hashes, names, result):
+		"""add a game: <hashes> of the setup and the positions after the
+		moves, with <names>, as in the pdn"""
+		score = self.results.get(result, 0)
+		for ply in xrange(min(len(hashes), self.depth + 1)):
+			tally = self.positions.get(hashes[ply])
+			if not tally:
+				tally = self.positions[hashes[ply]] = [0, 0, 0, 0]
+			tally[0] += 1
+			if score:
+				tally[score] += 1
+			if ply + 1 == len(hashes) or ply == self.depth:
+				break
+			replies = self.replies.setdefault(hashes[ply], {})
+			name = names[ply].rstrip('*!?')
+			reply = replies.get(name)
+			if not reply:
+				reply = replies[name] = [hashes[ply + 1], 0, 0, 0, 0]
+			reply[1] += 1
+			if score:
+				reply[1 + score] += 1
+
+	def explore(self, hash):
+		"""return the tally of position <hash>, None if not in the tree,
+		and its replies: move, hash, tally; the most played first"""
+		replies = [(name, reply[0], reply[1:]) for name, reply
+			in self.replies.get(hash, {}).iteritems()]
+		replies.sort(key=lambda reply: -reply[2][0])
+		return self.positions.get(hash), replies
+
+class Headers(object):
+	"""an index of the headers of the games in the book, for the search
+
+	per header, the lowercased values with the games, sorted, so the
+	games a prefix matches are between two bisections, and are taken as
+	a slice; the words in a value after the first are values too, so
+	"marion" finds "Tinsley, Marion"
+
+	games are added, as a search asks for them, merged into the sorted
+	lists then; a game whose headers changed is marked stale, the next
+	search takes its old values out and puts the new ones in
+	"""
+
+	keys = ('event', 'black', 'white', 'date', 'result', 'gametype')
+	words = ('event', 'black', 'white') # where plain words are looked up
+
+	def __init__(self):
+		self.clear()
+
+	def clear(self):
+		"forget all games"
+		self.games = 0 # indexed
+		self.indexed = [] # per game, the values as indexed
+		self.stale = set() # games whose headers changed since
+		self.values = dict([(key, []) for key in self.keys])
+		self.nums = dict([(key, []) for key in self.keys])
+		self.tail = dict([(key, []) for key in self.keys])
+
+	def entries(self, value, num):
+		"return the entries of <value> of game <num>, one per word"
+		entries = [(value, num)]
+		start = value.find(' ')
+		while start >= 0:
+			entries.append((value[start + 1:], num))
+			start = value.find(' ', start + 1)
+		return entries
+
+	def header_values(self, name, header):
+		"return the lowercased values of <name> and <header> to index"
+		values = []
+		for key in self.keys:
+			if key == 'event':
+				value = name
+			else:
+				value = header.get(key)
+			values.append(str(value or '').lower())
+		return tuple(values)
+
+	def add(self, num, name, header):
+		"add game <num>, named <name>, with <header>"
+		values = self.header_values(name, header)
+		for key, value in zip(self.keys, values):
+			self.tail[key].extend(self.entries(value, num))
+		self.indexed.append(values)
+		self.games += 1
+
+	def changed(self, num):
+		"the headers of game <num> changed"
+		if num < self.games:
+			self.stale.add(num)
+
+	def update(self, num, name, header):
+		"replace the values of stale game <num> by <name> and <header>"
+		self.stale.discard(num)
+		new = self.header_values(name, header)
+		for key, old, value in zip(self.keys, self.indexed[num], new):
+			if old == value:
+				continue
+			self.merge(key)
+			values, nums = self.values[key], self.nums[key]
+			for word, game in self.entries(old, num):
+				# equal values are sorted by game
+				start = bisect_left(values, word)
+				end = bisect_right(values, word, start)
+				pos = bisect_left(nums, game, start, end)
+				del values[pos], nums[pos]
+			self.tail[key].extend(self.entries(value, num))
+		self.indexed[num] = new
+
+	def merge(self, key):
+		"merge the games added since the last search into the index"
+		tail = self.tail[key]
+		if not tail:
+			return
+		entries = zip(self.values[key], self.nums[key]) + tail
+		entries.sort()
+		self.values[key] = [value for value, num in entries]
+		self.nums[key] = [num for value, num in entries]
+		self.tail[key] = []
+
+	def find(self, key, prefix):
+		"return the set of games, where header <key> starts with <prefix>"
+		self.merge(key)
+		values = self.values[key]
+		return set(self.nums[key][bisect_left(values, prefix):
+			bisect_left(values, prefix + '\xff')])
+
+	def matches(self, text, name, header):
+		"""return True, if the game named <name>, with <header>, matches
+		all the words of <text>, as the search would find it; the index
+		is not used"""
+		values = dict(zip(self.keys, self.header_values(name, header)))
+		for word in text.lower().split():
+			key, colon, prefix = word.partition(':')
+			if colon and key in self.keys:
+				keys = (key,)
+			else:
+				keys, prefix = self.words, word
+			for key in keys:
+				if [value for value, num in self.entries(values[key], None)
+					if value.startswith(prefix)]:
+					break
+			else:
+				return False
+		return True
+
+	def search(self, text):
+		"""return the set of games that match all the words of <text>,
+		None if there are none; "key:prefix" looks at one header only,
+		plain words at event, black and white"""
+		games = None
+		for word in text.lower().split():
+			key, colon, prefix = word.partition(':')
+			if colon and key in self.keys:
+				found = self.find(key, prefix)
+			else:
+				found = set()
+				for key in self.words:
+					found |= self.find(key, word)
+			if games is None:
+				games = found
+			else:
+				games &= found
+		return games
 
 class Book(gtk.TreeStore):
 	"""game history - a tree of all the games in the book
@@ -813,8 +1422,9 @@ class Book(gtk.TreeStore):
 	- games grow from the root
 	  games store a name, the setup position, etc.
 	- moves grow from a game
-	  moves contain the move as a string and as a list and
-	  the position after the move
+	  moves contain the move as a string and as a list, the captured
+	  squares and the new piece; only every keyframe-th move keeps the
+	  whole position after the move, the others are rebuilt from there
 
 	the currently active game is to be remembered between calls to
 	several methods, so persistant iters are required
@@ -822,6 +1432,21 @@ class Book(gtk.TreeStore):
 	output game headers are: gametype, black, white, result, date,
 	site, round, fen. other headers are not in the output pdn
 	the "event" header is in COL_NAME
+
+	games from a big pdn may be loaded lazily: then only the headers
+	are in the book, and COL_SRC tells where to find the moves in the
+	pdn source, until the game is first selected; their moves are
+	replayed from gobject idle, a batch of games at a time, for the
+	positions and openings, without the game.lock; a position search
+	replays the games left first
+
+	games from pdn keep where they are in the source in COL_SPAN, as
+	long as they are not changed, they are saved from there as they
+	were read; changes set COL_DIRTY, then the game is written anew
+
+	the search of the bookview hides the games, that do not match, by
+	COL_SHOW, that a gtk.TreeModelFilter looks at; the games hidden are
+	remembered, so a new search only touches those that change
 	"""
 
 	# general
@@ -831,22 +1456,59 @@ class Book(gtk.TreeStore):
 	COL_MOVE = 2 # move as a list
 	COL_STREN = 3
 	COL_ANNO = 4
-	COL_POS = 5
+	COL_POS = 5 # setup or keyframe position
 	COL_TURN = 6 # who's next
-	
+	COL_DELTA = 12 # captured squares, new piece
+	COL_HASH = 13 # zobrist hash of the position, with turn
+	# game
+	COL_DIRTY = 7 # changed since read from pdn
+	COL_SPAN = 10 # pdn source, start, end of the whole game
+	COL_SRC = 11 # source, start, end, line of moves not yet loaded
+	COL_SHOW = 14 # shown by the search, games and their moves
+	loader = None # the pdn, while it is loading; no games are added then
+	database = None # games are paged in from
+	paged = 0 # games of the database in the book
+	matched = None # ids of the games of the database, the search found
+	keyframe = 16 # plies between positions kept in the book
+	index_batch = 20 # games lazily loaded, that are replayed per idle call
+	indexer = None # the idle source, while games are left to replay
+
 	def __init__(self):
 		super(Book, self).__init__(
 			str, gobject.TYPE_PYOBJECT,
 			gobject.TYPE_PYOBJECT, str, str, gobject.TYPE_PYOBJECT, int,
-			int, str, str, str, gobject.TYPE_PYOBJECT,
-			gobject.TYPE_PYOBJECT)
+			int, str, str, gobject.TYPE_PYOBJECT, gobject.TYPE_PYOBJECT,
+			gobject.TYPE_PYOBJECT, gobject.TYPE_UINT64, bool)
 		assert self.get_flags() & gtk.TREE_MODEL_ITERS_PERSIST
+		self.positions = Positions()
+		self.openings = Openings()
+		self.headers = Headers()
+		self.replays = Replays()
+		self.hidden = set() # games the search does not show
+		self.fingerprints = {} # of the games appended from books
+		self.rows = {} # database ids to games
+		self.unindexed = deque() # games to replay: num, iter, move names
 
 	def do_clear(self):
 		"clear book"
 		if hasattr(self, 'game'):
 			del self.game
 		self.clear()
+		self.positions.clear()
+		self.openings.clear()
+		self.headers.clear()
+		self.replays.clear()
+		self.hidden = set()
+		self.fingerprints = {}
+		Main.bookview.clear_search()
+		self.database = None
+		self.rows = {}
+		self.paged = 0
+		self.matched = None
+		self.unindexed.clear()
+		if self.indexer:
+			gobject.source_remove(self.indexer)
+			self.indexer = None
 
 	def new_game(self, name, gametype, black, white, position, color):
 		"add a new game to the book, return path"
@@ -856,8 +1518,13 @@ class Book(gtk.TreeStore):
 				self.game = self.append(None)
 		path = self.get_path(self.game)
 		name = "Game " + str(path[0] + 1)
+		self.positions.add(position.key(color), path[0], -1)
+		self.headers.changed(path[0])
+		self.hidden.discard(path[0])
 		self.set(self.game, self.COL_NAME, name, self.COL_POS, position,
 			self.COL_TURN, color, self.COL_ANNO, '',
+			self.COL_HASH, position.key(color), self.COL_SRC, None,
+			self.COL_SPAN, None, self.COL_DIRTY, 0, self.COL_SHOW, True,
 			self.COL_HEAD, {'gametype': gametype,
 			'black': black, 'white': white, 'result': '*',
 			'date': str(today), 'site': '', 'round': '', 'fen': ''})
@@ -865,69 +1532,271 @@ class Book(gtk.TreeStore):
 		Main.bookview.scroll_to_cell(path, None, True)
 		return path
 
-	def pdn_game(self):
-		"add a new empty game to the book"
-		self.game = self.append(None)
-		self.set(self.game, self.COL_NAME, 'Pdn', self.COL_ANNO, '',
-			self.COL_HEAD, {'gametype': Game.ENGLISH,
-			'black': 'Black', 'white': 'White', 'result': '*',
-			'date': '', 'site': '', 'round': '', 'fen': ''})
+	def pdn_game(self, num, name, header, annotation, moves, source, hashes,
+		span, names=None):
+		"""add game <num> from pdn to the book, <hashes> are of the setup
+		and the positions after the moves, as far as they are known; the
+		game is at <span> in the source; a game, whose moves are left in
+		the <source>, may have the <names> of the moves, a scan found;
+		return the row of the game"""
+		iter = self.append(None)
+		if span and span[2] <= span[1]:
+			span = None
+		self.set(iter, self.COL_NAME, name, self.COL_HEAD, header,
+			self.COL_ANNO, annotation, self.COL_SRC, source,
+			self.COL_SPAN, span and tuple(span), self.COL_SHOW, True)
+		if hashes:
+			self.set_value(iter, self.COL_HASH, hashes[0])
+			self.positions.add(hashes[0], num, -1)
+			if moves:
+				self.openings.add(hashes, [move[0] for move in moves],
+					header['result'])
+			hashes = hashes[1:]
+		# the positions of the games of a database are in its table
+		if source and not moves and source[0] is not self.database:
+			self.unindexed.append((num, iter, names))
+			if not self.indexer:
+				self.indexer = gobject.idle_add(self.index_idle,
+					priority=gobject.PRIORITY_LOW)
+		self.pdn_moves(iter, num, moves, hashes)
+		return iter
+
+	def index_idle(self):
+		"replay a batch of the games left, called from gobject idle"
+		for count in xrange(self.index_batch):
+			if not self.unindexed:
+				self.indexer = None
+				return False
+			self.index_game(*self.unindexed.popleft())
+		return True
+
+	def index_pending(self):
+		"replay the games left at once, for a search"
+		if self.unindexed:
+			Main.feedback.g_push('Replaying %d games of the book'
+				% len(self.unindexed))
+		while self.unindexed:
+			self.index_game(*self.unindexed.popleft())
+
+	def index_game(self, num, game, names):
+		"""add the positions and openings of game <num> at <game>, whose
+		moves are still in the source, by their <names>, if the scan
+		found them"""
+		pending = self.get_value(game, self.COL_SRC)
+		# a game selected meanwhile is indexed
+		if not pending:
+			return
+		header = self.get_value(game, self.COL_HEAD)
+		if names is None:
+			source, start, end, line = pending
+			moves = source.load(start, end, line, header)[1]
+			names = [move[0] for move in moves]
+		else:
+			moves = [(name, '', '', [int(step) for step
+				in Pdn.step_re.split(name)]) for name in names]
+		hashes = self.replay(header, moves)
+		if not hashes:
+			return
+		if not self.get_value(game, self.COL_HASH):
+			self.set_value(game, self.COL_HASH, hashes[0])
+			self.positions.add(hashes[0], num, -1)
+		self.openings.add(hashes, names, header['result'])
+		for ply in xrange(1, len(hashes)):
+			self.positions.add(hashes[ply], num, ply - 1)
+
+	def pdn_moves(self, iter, num, moves, hashes, index=True):
+		"""append <moves> from pdn to game <num>, <hashes> are of the
+		positions after the moves, as far as they are known; they go to
+		the positions, unless the scan put them there, not to <index>"""
+		for ply in xrange(len(moves)):
+			name, strength, annotation, move = moves[ply]
+			hash = 0
+			if ply < len(hashes):
+				hash = hashes[ply]
+				if index:
+					self.positions.add(hash, num, ply)
+			self.pdn_move(iter, name, strength, annotation, move, hash)
+
+	def merge_game(self, num, name, header, annotation):
+		"""fill in the headers and annotation game <num> lacks, from the
+		same game, with <name>, <header> and <annotation>"""
+		game = self.iter_nth_child(None, num)
+		old = self.get_value(game, self.COL_HEAD)
+		changed = False
+		for key, default in (('black', 'Black'), ('white', 'White'),
+			('date', ''), ('site', ''), ('round', '')):
+			if old[key] in ('', default) and header[key] not in ('', default):
+				old[key] = header[key]
+				changed = True
+		if self.get_value(game, self.COL_NAME) == 'Pdn' and name != 'Pdn':
+			self.set_value(game, self.COL_NAME, name)
+			changed = True
+		if annotation and not self.get_value(game, self.COL_ANNO):
+			self.set_value(game, self.COL_ANNO, annotation)
+			changed = True
+		if changed:
+			self.set_dirty(game)
+			self.headers.changed(num)
+
+	def open_database(self, database):
+		"""show the games of <database>, page by page; return how many
+		are in the first page"""
+		self.do_clear()
+		self.database = database
+		return self.page_in()
+
+	def page_in(self):
+		"""put the next page of games from the database into the book;
+		while searching, on to the next game found, at least"""
+		if not self.database:
+			return 0
+		limit = self.database.page
+		if self.matched:
+			last = max(self.rows.keys() + [0])
+			ids = [id for id in self.matched if id > last]
+			if ids:
+				limit = max(limit,
+					self.database.offset(min(ids)) + 1 - self.paged)
+		games = self.database.games(self.paged, limit)
+		num = self.iter_n_children(None)
+		for id, record in games:
+			self.rows[id] = num
+			game = self.pdn_game(num, *record)
+			if self.matched is not None and id not in self.matched:
+				self.set_value(game, self.COL_SHOW, False)
+				self.hidden.add(num)
+			num += 1
+		self.paged += len(games)
+		return len(games)
+
+	def cancel_load(self):
+		"stop loading a pdn, keep the games already in the book"
+		if self.loader:
+			self.loader.cancel()
 
 	def goto_game(self, num):
 		"set game <num> as current, return game header"
 		iter = self.iter_nth_child(None, num)
 		assert iter
 		self.game = iter
+		self.load_game()
 		path = self.get_path(self.game)
 		Main.bookview.set_cursor(path)
 		Main.bookview.scroll_to_cell(path, None, True)
 		return (self.get_value(iter, self.COL_HEAD))
 
-	def old_game(self, position):
+	def load_game(self):
+		"parse the moves of the current game, if it was loaded lazily"
+		pending = self.get_value(self.game, self.COL_SRC)
+		if not pending:
+			return
+		self.set_value(self.game, self.COL_SRC, None)
+		source, start, end, line = pending
+		header = self.get_value(self.game, self.COL_HEAD)
+		annotation, moves = source.load(start, end, line, header)
+		hashes = self.replay(header, moves)
+		if annotation:
+			self.set_value(self.game, self.COL_ANNO, annotation)
+		num = self.get_path(self.game)[0]
+		if hashes and not self.get_value(self.game, self.COL_HASH):
+			self.set_value(self.game, self.COL_HASH, hashes[0])
+			self.positions.add(hashes[0], num, -1)
+		# the moves are in the index already, if they were replayed
+		index = not (len(hashes) > 1
+			and (num, 0) in self.positions.find(hashes[1]))
+		if moves and hashes and index:
+			self.openings.add(hashes, [move[0] for move in moves],
+				header['result'])
+		self.pdn_moves(self.game, num, moves, hashes[1:], index)
+
+	def replay(self, header, moves):
+		"""return the hashes of the setup and the positions after the pdn
+		<moves> of a game with <header>, if the rules know the gametype;
+		the pdn thread calls this too, the book is not touched"""
+		gametype, fen = header['gametype'], header['fen']
+		if not Main.rules.knows(gametype):
+			return []
+		if gametype == Game.ENGLISH:
+			color, position = Main.pos.english()
+		else:
+			color, position = Main.pos.mafierz()
+		if fen:
+			if not fen[0]:
+				return []
+			color, position = Main.pos.fen_setup(position, fen)
+		return Main.rules.replay(gametype, color, position,
+			[move[3] for move in moves])
+
+	def old_game(self, position, color):
 		"replace position in current old game, return old games' movelist"
 		movelist = self.get_movelist()
-		self.set_value(self.game, self.COL_POS, position)
+		hash = position.key(color)
+		if self.get_value(self.game, self.COL_HASH) != hash:
+			self.positions.add(hash, self.get_path(self.game)[0], -1)
+		self.set(self.game, self.COL_POS, position, self.COL_HASH, hash)
 		return movelist
 
+	def set_dirty(self, game):
+		"mark <game> as changed, it is no longer saved as it was read"
+		self.set_value(game, self.COL_DIRTY, 1)
+
 	def trunc_game(self, num):
 		"delete all moves after <num> from current game"
 		assert self.game
-		self.get_value(self.game, self.COL_HEAD)['result'] = '*'
+		self.set_dirty(self.game)
+		header = self.get_value(self.game, self.COL_HEAD)
+		if header['result'] != '*':
+			self.headers.changed(self.get_path(self.game)[0])
+		header['result'] = '*'
 		iter = self.iter_nth_child(self.game, num + 1)
 		while self.remove(iter): assert iter
 
-	def new_move(self, name, position, color, move):
+	def new_move(self, name, position, color, move, huffs, new):
 		"append move to current game, return path"
 		assert self.game
+		self.set_dirty(self.game)
 		iter = self.append(self.game)
-		self.set(iter, self.COL_NAME, name, self.COL_POS, position,
-			self.COL_TURN, color, self.COL_MOVE, move, self.COL_ANNO, '')
 		path = self.get_path(iter)
+		hash = position.key(color)
+		self.positions.add(hash, path[0], path[1])
+		if (path[1] + 1) % self.keyframe:
+			position = None
+		self.set(iter, self.COL_NAME, name, self.COL_POS, position,
+			self.COL_TURN, color, self.COL_MOVE, move, self.COL_ANNO, '',
+			self.COL_DELTA, new and (tuple(huffs), new) or None,
+			self.COL_HASH, hash, self.COL_SHOW, True)
 		Main.bookview.expand_to_path(path)
 		Main.bookview.set_cursor(path)
 		Main.bookview.scroll_to_cell(path)
 		return path
 
-	def pdn_move(self, name, strength, annotation, move):
-		"""append move from pdn to current game, some essential
-		parameters are only added later on replay, ie. old_move"""
-		assert self.game
-		iter = self.append(self.game)
+	def pdn_move(self, game, name, strength, annotation, move, hash):
+		"""append move from pdn to <game>, some essential parameters
+		are only added later on replay, ie. old_move"""
+		iter = self.append(game)
 		self.set(iter, self.COL_NAME, name, self.COL_STREN, strength,
-			self.COL_ANNO, annotation, self.COL_MOVE, move)
+			self.COL_ANNO, annotation, self.COL_MOVE, move,
+			self.COL_HASH, hash, self.COL_SHOW, True)
 
-	def old_move(self, num, name, position, color, move):
-		"replace position in move <num> in current game, return path"
+	def old_move(self, num, name, position, color, move, huffs, new):
+		"replace move <num> + 1 in current game, return path"
 		assert self.game
 		iter = self.iter_nth_child(self.game, num + 1)
 		assert iter
-		self.set(iter, self.COL_NAME, name, self.COL_POS, position,
-			self.COL_TURN, color, self.COL_MOVE, move)
+		hash = position.key(color)
 		path = self.get_path(iter)
+		if self.get_value(iter, self.COL_HASH) != hash:
+			self.positions.add(hash, path[0], path[1])
+		if (num + 2) % self.keyframe:
+			position = None
+		self.set(iter, self.COL_NAME, name, self.COL_POS, position,
+			self.COL_TURN, color, self.COL_MOVE, move,
+			self.COL_DELTA, new and (tuple(huffs), new) or None,
+			self.COL_HASH, hash)
 		return path
 
 	def get_move(self, num):
-		"get move <num>, return saved position and turn"
+		"get move <num>, return its position and turn"
 		assert self.game
 		if num < 0:
 			iter = self.game
@@ -937,9 +1806,119 @@ class Book(gtk.TreeStore):
 		Main.bookview.expand_to_path(path)
 		Main.bookview.set_cursor(path)
 		#Main.bookview.scroll_to_cell(path)
-		return (self.get_value(iter, self.COL_POS),
+		return (self.get_position(num),
 			self.get_value(iter, self.COL_TURN))
 
+	def get_position(self, num):
+		"return position after move <num>, rebuilt from the last keyframe"
+		key = num - (num + 1) % self.keyframe
+		if key < 0:
+			iter = self.game
+		else:
+			iter = self.iter_nth_child(self.game, key)
+		position = self.get_value(iter, self.COL_POS)
+		if key == num:
+			return position
+		position = position.copy()
+		index = position.layout.index
+		iter = self.iter_nth_child(self.game, key + 1)
+		for i in xrange(key, num):
+			delta = self.get_value(iter, self.COL_DELTA)
+			if delta:
+				steps = self.get_value(iter, self.COL_MOVE)
+				huffs, new = delta
+				position.set(index[steps[0]], Position.EMPTY)
+				position.set(index[steps[-1]], new)
+				for square in huffs:
+					position.set(index[square], Position.EMPTY)
+			iter = self.iter_next(iter)
+		return position
+
+	def find_position(self, hash):
+		"""return game and ply of the rows with position <hash>, in order;
+		the moves of games paged in from a database may not be loaded yet"""
+		self.index_pending()
+		hits = []
+		found = set(self.positions.find(hash))
+		if self.database:
+			found.update(self.database.find(hash, self.rows))
+		for game, ply in sorted(found):
+			iter = self.iter_nth_child(None, game)
+			if iter and ply >= 0 and self.get_value(iter, self.COL_SRC):
+				hits.append((game, ply))
+				continue
+			if iter and ply >= 0:
+				iter = self.iter_nth_child(iter, ply)
+			if iter and self.get_value(iter, self.COL_HASH) == hash:
+				hits.append((game, ply))
+		return hits
+
+	def search(self, text):
+		"""return the set of games, whose headers match the words of
+		<text>, None for all; games not yet in the index are added. of a
+		database, all games are searched by a query, those paged in are
+		returned, the others are shown, as they are paged in"""
+		if self.database:
+			self.matched = self.database.search(text)
+			if self.matched is None:
+				return None
+			return set([self.rows[id] for id in self.matched
+				if id in self.rows])
+		num = self.headers.games
+		game = self.iter_nth_child(None, num)
+		while game:
+			self.headers.add(num, *self.get(game, self.COL_NAME,
+				self.COL_HEAD))
+			num += 1
+			game = self.iter_next(game)
+		for num in list(self.headers.stale):
+			self.headers.update(num, *self.get(self.iter_nth_child(None,
+				num), self.COL_NAME, self.COL_HEAD))
+		return self.headers.search(text)
+
+	def show(self, games):
+		"""let the search show only <games>, all for None; only the
+		rows, that change, are set"""
+		hidden = set()
+		if games is not None:
+			hidden = set(xrange(self.iter_n_children(None)))
+			hidden -= games
+		num = -1
+		for change in sorted(self.hidden ^ hidden):
+			# step along, unless it is far
+			if change - num > 64 or num < 0:
+				game = self.iter_nth_child(None, change)
+			else:
+				while num < change:
+					game = self.iter_next(game)
+					num += 1
+			num = change
+			self.set_value(game, self.COL_SHOW, change not in hidden)
+		self.hidden = hidden
+
+	def show_game(self, num, game, text):
+		"""let the search show game <num>, at row <game>, only if it
+		matches <text>; the other games are not looked at"""
+		shown = self.headers.matches(text, *self.get(game, self.COL_NAME,
+			self.COL_HEAD))
+		if shown != (num not in self.hidden):
+			self.set_value(game, self.COL_SHOW, shown)
+			if shown:
+				self.hidden.discard(num)
+			else:
+				self.hidden.add(num)
+
+	def next_shown(self, num, step):
+		"""return the game after <num>, before it for a negative <step>,
+		that the search shows; <num> if there is none"""
+		next = num + step
+		while next in self.hidden:
+			next += step
+		if next < 0 or next != num + step \
+			and next >= self.iter_n_children(None):
+			return num
+		return next
+
 	def get_movelist(self):
 		"return list of the moves in the current game"
 		move = self.iter_children(self.game)
@@ -951,7 +1930,11 @@ class Book(gtk.TreeStore):
 
 	def set_result(self, result):
 		"replace result in current game"
-		self.get_value(self.game, self.COL_HEAD).update({'result' : result})
+		header = self.get_value(self.game, self.COL_HEAD)
+		if header['result'] != result:
+			self.set_dirty(self.game)
+			self.headers.changed(self.get_path(self.game)[0])
+		header.update({'result' : result})
 
 	def fen2str(self, fen):
 		"return fen as a string"
@@ -978,98 +1961,537 @@ class Book(gtk.TreeStore):
 		return fstr
 
 	def wrap(self, text, width):
-		"""
-		A word-wrap function that preserves existing line breaks
-		and most spaces in the text. Expects that existing line
-		breaks are posix newlines (\n).
-		http://aspn.activestate.com/ASPN/Cookbook/Python/Recipe/148061
-		"""
-		return reduce(lambda line, word, width=width: '%s%s%s' %
-			(line,
-				' \n'[(len(line)-line.rfind('\n')-1
-				+ len(word.split('\n',1)[0]
-					) >= width)],
-				word),
-				text.split(' ')
-			)
+		"""return <text> wrapped at <width>, existing line breaks are kept;
+		linear in the length of the text"""
+		words = text.split(' ')
+		lines = [words[0]]
+		column = len(words[0]) - words[0].rfind('\n') - 1
+		for word in words[1:]:
+			first = word.find('\n')
+			if first < 0:
+				first = len(word)
+			if column + first >= width:
+				lines.append('\n')
+				column = 0
+			else:
+				lines.append(' ')
+				column += 1
+			lines.append(word)
+			if first == len(word):
+				column += first
+			else:
+				column = len(word) - word.rfind('\n') - 1
+		return ''.join(lines)
 
-	def game2pdn(self):
-		"return current game as a pdn string, wrapped email friendly"
-		game = self.get_value(self.game, self.COL_NAME)
-		header = self.get_value(self.game, self.COL_HEAD)
+	def iter_moves(self, game):
+		"yield name, strength, annotation of the moves of <game>"
+		move = self.iter_children(game)
+		while move:
+			yield self.get(move, self.COL_NAME, self.COL_STREN, self.COL_ANNO)
+			move = self.iter_next(move)
+
+	def read_game(self, game):
+		"""return name, header, annotation and moves of <game>, these as
+		name, strength, annotation; the moves of a lazily loaded game are
+		parsed, but kept out of the book"""
+		name, header, annotation, pending = self.get(game, self.COL_NAME,
+			self.COL_HEAD, self.COL_ANNO, self.COL_SRC)
+		if not pending:
+			return name, header, annotation, self.iter_moves(game)
+		source, start, end, line = pending
+		header = header.copy()
+		anno, moves = source.load(start, end, line, header)
+		return name, header, anno or annotation, \
+			[move[:3] for move in moves]
+
+	def write_game(self, f, game):
+		"""write <game> as pdn to file <f>, wrapped email friendly; a game
+		from pdn, that was not changed, is copied from the source"""
+		span = self.get_value(game, self.COL_SPAN)
+		if span and not self.get_value(game, self.COL_DIRTY):
+			source, start, end = span
+			source.write(f, start, end)
+			f.write('\n')
+			return
+		name, header, annotation, moves = self.read_game(game)
 		gametype, black, white, date, site, round, result, fen = \
 			header['gametype'], header['black'], header['white'], \
 			header['date'], header['site'], header['round'], \
 			header['result'], header['fen']
 
-		pdn = """[Event "%s"]\n""" % game
+		pdn = ['[Event "%s"]\n' % name]
 		if date:
-			pdn = pdn + """[Date "%s"]\n""" % date
+			pdn.append('[Date "%s"]\n' % date)
 		if black != 'Black':
-			pdn = pdn + """[Black "%s"]\n""" % black
+			pdn.append('[Black "%s"]\n' % black)
 		if white != 'White':
-			pdn = pdn + """[White "%s"]\n""" % white
+			pdn.append('[White "%s"]\n' % white)
 		if site:
-			pdn = pdn + """[Site "%s"]\n""" % site
+			pdn.append('[Site "%s"]\n' % site)
 		if round:
-			pdn = pdn + """[Round "%s"]\n""" % round
+			pdn.append('[Round "%s"]\n' % round)
 		if gametype != Game.ENGLISH:
-			pdn = pdn + """[Gametype "%s"]\n""" % gametype
-		pdn = pdn + """[Result "%s"]\n""" % result
+			pdn.append('[Gametype "%s"]\n' % gametype)
+		pdn.append('[Result "%s"]\n' % result)
 		if fen:
-			fstr = self.fen2str(fen)
-			pdn = pdn + """[FEN "%s"]\n""" % fstr
-		anno = self.get_value(self.game, self.COL_ANNO)
-		if anno:
-			pdn = pdn + """{%s}\n""" % self.wrap(anno, 72)
-
-		move = self.iter_children(self.game)
+			pdn.append('[FEN "%s"]\n' % self.fen2str(fen))
+		if annotation:
+			pdn.append('{%s}\n' % self.wrap(annotation, 72))
+		pdn.append(self.movetext(moves))
+		pdn.append(' %s\n' % result)
+		f.write(''.join(pdn))
+
+	def movetext(self, moves):
+		"return <moves>: name, strength, annotation as a wrapped pdn movelist"
 		movelist = []
 		count = 2
-		while move:
+		for name, stren, anno in moves:
 			if count % 2 == 0:
 				movelist.append(str(count / 2) + '.')
 			count += 1
-			name = self.get_value(move, self.COL_NAME)
-			stren = self.get_value(move, self.COL_STREN)
-			anno = self.get_value(move, self.COL_ANNO)
 			if stren:
 				name = name + stren
 			if anno:
 				name = name + ' {' + anno + '}'
 			movelist.append(name)
-			move = self.iter_next(move)
-		movelist = ' '.join(movelist)
-		pdn = pdn + self.wrap(movelist, 72)
-		pdn = pdn + ' %s\n' % (result)
-		return game, pdn
+		return self.wrap(' '.join(movelist), 72)
+
+	def write_book(self, f, games=None):
+		"""write all games of the book as pdn to file <f>, or only those
+		with their numbers in the set <games>; return how many"""
+		game = self.get_iter_first()
+		num = count = 0
+		while game:
+			if games is None or num in games:
+				if count:
+					f.write('\n')
+				self.write_game(f, game)
+				count += 1
+			game = self.iter_next(game)
+			num += 1
+		return count
 
-import shlex
+	def game2pdn(self):
+		"return name and current game as a pdn string"
+		self.load_game()
+		f = StringIO()
+		self.write_game(f, self.game)
+		return self.get_value(self.game, self.COL_NAME), f.getvalue()
+
+import mmap
+import zlib
+import bz2
+import gzip
+try:
+	import lzma
+except ImportError:
+	try:
+		from backports import lzma
+	except ImportError:
+		lzma = None
+
+class PdnStream(object):
+	"""a compressed pdn file, read through a decompressor
+
+	gzip, bzip2 and xz are told by the magic bytes at the start of the
+	file, the stream is inflated in chunks, as it is read, there is no
+	temporary file; files of several streams are read on to the end,
+	what follows the last stream, that is no stream, is taken as the end.
+	xz needs the lzma module, that may be missing
+
+	written files are compressed as their extension tells
+	"""
 
-class Pdn(shlex.shlex):
+	formats = (('\x1f\x8b', 'gzip'), ('BZh', 'bz2'), ('\xfd7zXZ\x00', 'xz'))
+	errors = (IOError, zlib.error) + (lzma and (lzma.LZMAError,) or ())
+	chunk = 65536 # bytes read at once
+
+	def __init__(self, raw, kind):
+		self.raw = raw
+		self.kind = kind
+		self.magic = dict([(k, m) for m, k in self.formats])[kind]
+		self.rewind()
+
+	@staticmethod
+	def open(name):
+		"open file <name> for reading pdn, return a file or a stream"
+		f = open(name, 'rb')
+		head = f.read(8)
+		f.seek(0)
+		for magic, kind in PdnStream.formats:
+			if head.startswith(magic):
+				if kind == 'xz' and not lzma:
+					f.close()
+					raise IOError('no lzma module to read %s' % name)
+				return PdnStream(f, kind)
+		return f
+
+	@staticmethod
+	def create(name, path=None):
+		"""open <path>, or <name>, for writing pdn, compressed as the
+		extension of <name> tells"""
+		path = path or name
+		if name.endswith('.gz'):
+			return gzip.GzipFile(path, 'wb')
+		if name.endswith('.bz2'):
+			return bz2.BZ2File(path, 'w')
+		if name.endswith('.xz'):
+			if not lzma:
+				raise IOError('no lzma module to write %s' % name)
+			return lzma.LZMAFile(path, 'w')
+		return open(path, 'w')
+
+	def decompressor(self):
+		"return a new decompressor for the format"
+		if self.kind == 'gzip':
+			return zlib.decompressobj(16 + zlib.MAX_WBITS)
+		if self.kind == 'bz2':
+			return bz2.BZ2Decompressor()
+		return lzma.LZMADecompressor()
+
+	def rewind(self):
+		"go back to the start of the file"
+		self.raw.seek(0)
+		self.unpack = self.decompressor()
+		self.streams = 0 # ended
+		self.rest = '' # the start of a magic, cut by the chunk
+		self.buf = ''
+		self.at = 0 # in the buffer
+		self.pos = 0 # bytes read, inflated
+
+	def inflate(self, data):
+		"""return the text in <data>, a stream that follows another one
+		gets a new decompressor; from data, that is no stream, or a
+		broken stream after the first, on, there is no more text"""
+		text = []
+		data = self.rest + data
+		self.rest = ''
+		while data and self.unpack:
+			try:
+				text.append(self.unpack.decompress(data))
+			except EOFError:
+				self.streams += 1 # ended with the data before
+			except self.errors:
+				if not self.streams:
+					raise
+				self.unpack = None
+				break
+			else:
+				data = getattr(self.unpack, 'unused_data', '')
+				if not data:
+					break
+				self.streams += 1
+			if data.startswith(self.magic):
+				self.unpack = self.decompressor()
+			elif self.magic.startswith(data):
+				self.rest = data
+				break
+			else:
+				self.unpack = None
+		return ''.join(text)
+
+	def fill(self):
+		"inflate more of the file into the buffer, return False at the end"
+		self.buf = self.buf[self.at:]
+		self.at = 0
+		while True:
+			data = self.raw.read(self.chunk)
+			if not data:
+				return False
+			text = self.inflate(data)
+			if text:
+				self.buf += text
+				return True
+
+	def read(self, size=-1):
+		"return up to <size> bytes, all that is left, if not given"
+		while (size < 0 or len(self.buf) - self.at < size) and self.fill():
+			pass
+		if size < 0:
+			size = len(self.buf) - self.at
+		text = self.buf[self.at:self.at + size]
+		self.at += len(text)
+		self.pos += len(text)
+		return text
+
+	def readline(self):
+		"return the next line, an empty string at the end"
+		end = self.buf.find('\n', self.at)
+		while end < 0:
+			if not self.fill():
+				end = len(self.buf)
+				break
+			end = self.buf.find('\n', self.at)
+		else:
+			end += 1
+		text = self.buf[self.at:end]
+		self.at = end
+		self.pos += len(text)
+		return text
+
+	def __iter__(self):
+		return iter(self.readline, '')
+
+	def skip(self, size):
+		"read on <size> bytes, without keeping them"
+		while size > 0:
+			size -= len(self.read(min(size, self.chunk))) or size
+
+	def tell(self):
+		"return the bytes read, inflated"
+		return self.pos
+
+	def seek(self, pos):
+		"go to offset <pos>, inflated; going back reads from the start"
+		if pos < self.pos:
+			self.rewind()
+		self.skip(pos - self.pos)
+
+	def fileno(self):
+		return self.raw.fileno()
+
+	def close(self):
+		self.raw.close()
+
+class PdnSource(object):
+	"""where the games of a book are read from
+
+	a file is mapped into memory, when it is opened for parsing: the
+	parser tokenizes the map, lazily loaded games are read from it,
+	unchanged games are written from it to a saved book, without a copy;
+	text from the clipboard is kept here. the map is of the file, as it
+	was opened, a book saved over it later does not change it
+
+	a compressed file cannot be mapped, it is read through a stream of
+	its own, that goes on forward and only rewinds for a game further up;
+	a file, that cannot be mapped, is kept open, and read from
+	"""
+
+	def __init__(self, name, text=None):
+		self.name = name
+		self.text = text
+		self.map = None
+		self.file = None # that cannot be mapped
+		self.stream = None # of a compressed file
+
+	def data(self):
+		"return the text, or the map of the file"
+		if self.text is not None:
+			return self.text
+		return self.map
+
+	def mapped(self, f):
+		"""map the file <f> is open on, return the map, None if it cannot
+		be; a compressed file gets a stream of its own, a file, that
+		cannot be mapped, is opened again, for reading the games"""
+		if isinstance(f, PdnStream):
+			self.stream = PdnStream(open(self.name, 'rb'), f.kind)
+			return None
+		if not isinstance(f, file):
+			return None
+		try:
+			if os.fstat(f.fileno()).st_size:
+				self.map = mmap.mmap(f.fileno(), 0,
+					access=mmap.ACCESS_READ)
+				return self.map
+		except (EnvironmentError, ValueError):
+			pass
+		self.file = open(self.name, 'rb')
+		return None
+
+	def load(self, start, end, line, header):
+		"""parse the pdn from offset <start> to <end>, at <line>, the
+		movelist of a game with <header>; return annotation and moves"""
+		pdn = Pdn(self.read(start, end), self.name)
+		pdn.lineno = line
+		return pdn.parse_body(header)
+
+	def read(self, start, end):
+		"return the text from offset <start> to <end>"
+		if self.stream:
+			self.stream.seek(start)
+			return self.stream.read(end - start)
+		if self.file:
+			self.file.seek(start)
+			return self.file.read(end - start)
+		return (self.data() or '')[start:end]
+
+	def write(self, f, start, end):
+		"write the text from offset <start> to <end> to file <f>"
+		if self.data() is None or not isinstance(f, file):
+			f.write(self.read(start, end))
+		else:
+			f.write(buffer(self.data(), start, end - start))
+
+import re
+import marshal
+import hashlib
+from StringIO import StringIO
+
+class Pdn:
 	"""load games from pdn file
 
 	as the parser is quite small, its put here too. the globals game and
-	move are counts that match paths into the books treestore. 
+	move are counts that match paths into the books treestore.
 
 	this gets a filename, parses the games in the file and writes them to
 	the book, then points the game at the first loaded game; moves are not
 	checked for validity here
+
+	the tokenizer splits the text with a single compiled expression into
+	headers, annotations, moves, move numbers, results and stray text;
+	lines are only counted for warnings. a file is mapped into memory and
+	tokenized from the map, text is tokenized as it is, other streams are
+	read in chunks; only the tokens become python strings
+
+	the book is parsed in a thread, that collects the games as records:
+	name, header, annotation, moves, source, the hashes of the positions,
+	where the rules know the gametype, and the span of the game in the
+	source, from its first header to its last token; these are put into the
+	book in batches from gobject idle, the bookview shows them as they
+	come, a search only looks at the new ones. a book, that replaces the
+	one before, holds the game.lock until its first batch is in, the
+	first game is shown then; while the book is loading, games may be
+	selected, but none added, see Book.loader; stop cancels
+
+	in lazy mode, the file is only scanned line by line for the headers,
+	the offsets of the movelists are saved with the games in the book;
+	the moves outside of annotations are picked up by name, the records
+	have them last, for the book to replay them later, from idle.
+	what the scan found is kept in an index in the cache, to be used as
+	long as the file has the same size, mtime, inode, ctime and head and
+	tail, also when duplicates are dropped or merged
+
+	books may be appended to the book, one after the other; games that
+	are in the book already may then be dropped or merged: the thread
+	adds a fingerprint of setup, result and moves to the records, the
+	book keeps those it has in a dict
 	"""
 
+	token_re = re.compile(r"""
+		\s+
+		|(?P<header>\[\s*(?P<key>\w+)\s*
+			(?:"(?P<value>[^"]*)"|(?P<bare>[^\]\s]*))(?P<junk>[^\]]*)\])
+		|(?P<annotation>\{(?P<text>[^}]*)\})
+		|(?P<result>(?:1-0|0-1|1/2-1/2|\*)(?=[\s{\[]|$))
+		|(?P<move>(?P<steps>\d+(?:[-x]\d+)+)(?P<strength>[*!?]?)(?=[\s{\[]|$))
+		|(?P<number>\d+\.*(?=[\s{\[]|$))
+		|(?P<stray>[^\s{\[]+|[{\[])
+		""", re.VERBOSE)
+	header_re = re.compile(r'\[\s*(\w+)\s*"([^"]*)"\s*\]')
+	move_re = re.compile(r'(?<![\d/])[1-9]\d*(?:[-x][1-9]\d*)+(?![\d/])')
+	result_re = re.compile(r'(?<!\S)(?:1-0|0-1|1/2-1/2)(?=[\s{\[]|$)')
+	step_re = re.compile('[-x]')
+	chunk = 65536 # bytes read at once
+	batch = 50 # games put into the book at once
+	index_magic = 'capers pdn index'
+	index_version = 3
+	index_block = 65536 # bytes hashed at head and tail
+	duplicates = None # or 'drop' or 'merge'
+
 	def __init__(self, stream, filename):
-		"init lexer in posix mode, prepare parser"
-		# not a new style class
-		#super(Pdn, self).__init__()
-		shlex.shlex.__init__(self, stream, filename, True)
-		self.wordchars = self.wordchars + """.-/'<>*!?"""
-		self.quotes = '"'
+		"prepare tokenizer and parser"
+		if isinstance(stream, basestring):
+			self.source = PdnSource(filename, stream)
+			self.data = stream
+			stream = StringIO(stream)
+		else:
+			self.source = PdnSource(filename)
+			self.data = self.source.mapped(stream)
+		self.instream = stream
+		self.offset = 0 # bytes read
+		self.lineno = 1 # at lineat in the buffer
+		self.lineat = 0
+		self.buf = ''
+		self.start = 0 # of the token
 		self.pdn_state = 'none'
 		self.pdn_trace = False
 		self.game = -1
 		self.move = -1
+		self.moves = 0 # total
+		self.record = None # name, header, annotation, moves, source, ...
+		self.pending = [] # records for the next batch
+		self.inserted = 0 # games in the book
+		self.cancelled = False
+		self.index = []
+		self.found = [] # moves and results the scan found in the game
+		self.results = []
+		self.first = 0 # game in the book
+		self.dropped = 0 # duplicates
+		self.following = () # books to append after
+		self.locked = False # game.lock, until the first game is shown
 		self.name = filename
 
+	def error_leader(self):
+		"return file and line of the current token, for warnings"
+		buf, end = self.buf, self.start
+		for pos in xrange(self.lineat, end, self.chunk):
+			self.lineno += buf[pos:min(pos + self.chunk, end)].count('\n')
+		self.lineat = max(self.lineat, end)
+		return '"%s", line %d: ' % (self.name, self.lineno)
+
+	def tell(self, pos):
+		"return the offset in the source of <pos> in the buffer"
+		return self.offset - len(self.buf) + pos
+
+	def position(self):
+		"return how far the file is read, in bytes of the file, for progress"
+		if isinstance(self.instream, PdnStream):
+			return self.instream.raw.tell()
+		return self.tell(self.start)
+
+	def tell_end(self, pos):
+		"""return the offset in the source, where the text before <pos> in
+		the buffer ends, whitespace left out"""
+		while pos and self.buf[pos - 1].isspace():
+			pos -= 1
+		return self.tell(pos)
+
+	def tokens(self):
+		"""yield tokens: kind, text, value; a token that reaches the end of
+		the buffer might go on in the next chunk, so read on first; text
+		and maps are whole"""
+		match = self.token_re.match
+		eof = self.data is not None
+		if eof:
+			self.buf = self.data
+			self.offset = len(self.data)
+		buf = self.buf
+		pos = 0
+		while True:
+			m = match(buf, pos)
+			if not eof and (not m or m.end() == len(buf)
+				or m.group() in ('{', '[')):
+				chunk = self.instream.read(self.chunk)
+				eof = not chunk
+				self.offset += len(chunk)
+				self.lineno += buf.count('\n', self.lineat, pos)
+				self.lineat = 0
+				buf = self.buf = buf[pos:] + chunk
+				pos = 0
+				continue
+			if not m:
+				return
+			self.start = pos
+			pos = m.end()
+			kind = m.lastgroup
+			if not kind:
+				continue
+			if kind == 'header':
+				value = m.group('value')
+				if value is None:
+					value = m.group('bare')
+				for junk in m.group('junk').split():
+					print self.error_leader(), \
+						'stray text in header: "%s"' %junk
+				yield kind, m.group('key'), value
+			elif kind == 'annotation':
+				yield kind, ' '.join(m.group('text').split()), None
+			elif kind == 'move':
+				yield kind, m.group('steps'), m.group('strength')
+			else:
+				yield kind, m.group(), None
+
 	def parse_fen(self, fen):
 		"parse fen string: setup position, return turn, bpos, wpos"
 		def num_val(square, color):
@@ -1099,179 +2521,827 @@ class Pdn(shlex.shlex):
 			return [0, 0, 0]
 		return turn, black, white
 
-	def parse_header(self):
-		"parse headers: key, value; save to book, increment game counter"
-		if not self.pdn_state == 'headers':
-			# got new game
-			self.pdn_state = 'headers'
-			self.game += 1
-			self.move = -1
-			# create empty game in book
-			Main.book.pdn_game()
-			Main.feedback.g_push('Loading game: %3i' % self.game)
-			# parsing may take some time
-			while gtk.events_pending():
-				gtk.main_iteration(False)
-		key = self.get_token()
-		value = self.get_token()
-		header = Main.book[self.game][Book.COL_HEAD]
+	def begin_game(self, start=None, end=None):
+		"""got new game at offset <start>: start empty record, increment
+		game counter; the game before ended at offset <end>"""
+		self.end_game(end)
+		self.pdn_state = 'headers'
+		self.game += 1
+		self.move = -1
+		self.record = ['Pdn', {'gametype': Game.ENGLISH,
+			'black': 'Black', 'white': 'White', 'result': '*',
+			'date': '', 'site': '', 'round': '', 'fen': ''}, '', [], None,
+			None, start is not None and [self.source, start, start] or None,
+			None]
+
+	def end_game(self, end=None):
+		"""pass the record of the current game on, in batches; the game
+		ended at offset <end>"""
+		if not self.record: return
+		if end is not None and self.record[6]:
+			self.record[6][2] = end
+		self.record[5] = self.replay(self.record)
+		if self.duplicates:
+			self.record.append(self.fingerprint(self.record[1]['gametype'],
+				self.record[1]['fen'], *self.played(self.record)))
+		self.pending.append(self.record)
+		self.record = None
+		if len(self.pending) >= self.batch:
+			gobject.idle_add(self.insert, self.pending, self.position())
+			self.pending = []
+
+	def set_header(self, key, value):
+		"save header to record"
 		if self.pdn_trace:
 			print """H:%s,:	[%s "%s"]""" % (self.game, key, value)
 		if key.lower() == 'event':
-			Main.book[self.game][Book.COL_NAME] = value
+			self.record[0] = value
 		elif key.lower() == 'gametype':
-			Main.book[self.game][Book.COL_HEAD]['gametype'] = int(value)
+			self.record[1]['gametype'] = int(value)
 		elif key.lower() == 'fen':
-			Main.book[self.game][Book.COL_HEAD]['fen'] = self.parse_fen(value)
+			self.record[1]['fen'] = self.parse_fen(value)
 		else:
-			Main.book[self.game][Book.COL_HEAD][key.lower()] = value
-		# discard rest of line
-		for token in iter(self.get_token, None):
-			if token == ']':
-				return
-			print self.error_leader(), 'stray text in header: "%s"' %token
-
-	def parse_annotation(self):
-		"parse annotation, return it"
-		annotation = self.get_token()
-		# drop empty annotations
-		if annotation == '}': return ''
-		for token in iter(self.get_token, None):
-			if token == '}':
-				if self.pdn_trace:
-					print "A:%s,%s:	{%s}" % (self.game, self.move, annotation)
-				return annotation
-			annotation = ' '.join((annotation, token))
+			self.record[1][key.lower()] = value
 
 	def move_split(self, move):
 		"split a move, return list of integers"
-		if move.count('-'):
-			steps = move.split('-')
-			try:
-				return [int(x) for x in steps] 
-			except ValueError:
-				print self.error_leader(), 'stray text in movelist: "%s"' %move
-				return [0, 0]
-		elif move.count('x'):
-			steps = move.split('x')
-			try:
-				return [int(x) for x in steps] 
-			except ValueError:
-				print self.error_leader(), 'stray text in movelist: "%s"' %move
-				return [0, 0]
-		else:
-			return [False]
+		return [int(x) for x in self.step_re.split(move)]
 
-	def parse_move(self):
-		"parse single move: hops, strength, annotation; return them"
-		steps = []
-		move = strength = annotation = ''
-		for token in iter(self.get_token, None):
-			# move
-			if not steps and token[0] in '1234567890':
-				# strength
-				if token[-1] in '*!?':
-					strength = token[-1]
-					steps = self.move_split(token[:-1])
-				else:
-					steps = self.move_split(token)
-				# eat move numbers
-				if len(steps) < 2:
-					steps = []
-					move = strength = annotation = ''
-					continue
-				self.move += 1
-				move = token
-				continue
-			#annotation
-			if token == '{':
-				annotation = self.parse_annotation()
-				continue
-			# push back the rest
-			self.push_token(token)
-			break
-		if self.pdn_trace:
-			print "M:%s,%s:	%s" %(self.game, self.move, steps)
-		return (move, steps, strength, annotation)
-
-	def parse_moves(self):
-		"parse movelist: moves, result; save them to book"
-		def set_result(result):
-			"set result in book"
-			if self.game < 0: return
-			Main.book[self.game][Book.COL_HEAD]['result'] = result
-			self.pdn_state = 'none'
-		result = ''
-		for token in iter(self.get_token, None):
-			# result: unknown
-			if token ==  '*':
-				self.pdn_state = 'none'
-				continue
-			# result: first wins
-			elif token ==  '1-0':
-				set_result(token)
-				continue
-			# result: second wins
-			elif token ==  '0-1':
-				set_result(token)
-				continue
-			# result: draw
-			elif token ==  '1/2-1/2':
-				set_result(token)
-				continue
-			# shift move
-			elif token[0] in '1234567890':
-				if self.game < 0:
-					continue
-				self.push_token(token)
-				data = self.parse_move()
-				move, steps, strength, annotation = data
-				if move and len(steps) > 1:
-					Main.book.pdn_move(move, strength, annotation, steps)
-				continue
-			if token == '[':
-				self.push_token(token)
+	def set_result(self, result):
+		"set result in record"
+		self.pdn_state = 'none'
+		if not self.record or result == '*': return
+		self.record[1]['result'] = result
+
+	def parse_body(self, header):
+		"""parse annotation, movelist of a game, its <header> is in the
+		book already; return annotation and moves"""
+		self.game = 0
+		self.record = [None, header, '', [], None, None, None, None]
+		self.pdn_state = 'moves'
+		self.parse_book()
+		return self.record[2], self.record[3]
+
+	def replay(self, record):
+		"""return the hashes of the setup and the positions after the moves
+		of <record>, if the rules know the gametype; the moves a scan left
+		in the source are replayed by the book"""
+		if record[4] and not record[3]:
+			return record[5]
+		return Main.book.replay(record[1], record[3])
+
+	def played(self, record):
+		"return the names of the moves of <record> and its result"
+		if record[4] and not record[3]:
+			return record[7] or [], record[1]['result']
+		return [move[0] for move in record[3]], record[1]['result']
+
+	def fingerprint(self, gametype, fen, names, result):
+		"""return a digest of a game of <gametype> from <fen>, with the
+		moves <names> and <result>; the moves from and to only, so the
+		notation is not part of it, annotations and headers neither"""
+		if fen and fen[0]:
+			fen = fen[0], sorted(fen[1].items()), sorted(fen[2].items())
+		moves = []
+		for name in names:
+			steps = self.step_re.split(name.rstrip('*!?'))
+			moves.append(steps[0] + '-' + steps[-1])
+		return hashlib.md5('%s\n%r\n%s\n%s' % (gametype, fen,
+			result.replace(' ', '-'), ' '.join(moves))).digest()
+
+	def scan_comment(self, line, comment):
+		"""return True, if <line> ends within an annotation, and the
+		number of moves outside of annotations"""
+		pos = moves = 0
+		while True:
+			if comment:
+				end = line.find('}', pos)
+			else:
+				end = line.find('{', pos)
+				found = self.move_re.findall(line, pos,
+					end < 0 and len(line) or end)
+				moves += len(found)
+				self.found.extend(found)
+				self.results.extend(self.result_re.findall(line, pos,
+					end < 0 and len(line) or end))
+			if end < 0:
+				return comment, moves
+			comment = not comment
+			pos = end + 1
+
+	def scan_end(self, start, end, line, moves, last):
+		"""the moves of the current game are from <start> to <end>, the
+		game ends at <last>"""
+		if not self.record: return
+		self.record[4] = (self.source, start, end, line)
+		self.record[6][2] = last
+		if self.results:
+			self.set_result(self.results[-1])
+		self.record[7] = self.found
+		self.moves += moves
+		self.index.append((self.record[0], self.record[1],
+			start, end, line, moves, self.record[6][1], last,
+			self.record[7]))
+
+	def scan(self):
+		"scan book for games: save headers and where the moves are to book"
+		offset = start = lineno = moves = last = 0
+		line = 1
+		comment = False
+		lines = self.instream
+		if self.data is not None and self.source.text is None:
+			self.data.seek(0)
+			lines = iter(self.data.readline, '')
+		for text in lines:
+			lineno += 1
+			if not comment and text.lstrip().startswith('['):
+				if not self.pdn_state == 'headers':
+					if self.cancelled:
+						return
+					self.scan_end(start, offset, line, moves, last)
+					self.offset = offset
+					self.begin_game(offset + len(text) - len(text.lstrip()))
+					self.found = []
+					self.results = []
+					moves = 0
+				self.lineno = lineno
+				for key, value in self.header_re.findall(text):
+					self.set_header(key, value)
+				start = offset + len(text)
+				line = lineno + 1
+			else:
+				if self.pdn_state == 'headers':
+					self.pdn_state = 'moves'
+				comment, count = self.scan_comment(text, comment)
+				moves += count
+			if not text.isspace():
+				last = offset + len(text.rstrip())
+			offset += len(text)
+		self.scan_end(start, offset, line, moves, last)
+
+	def index_stat(self):
+		"""return the cache file for the index of the book, and what the
+		index must match: size, mtime, inode, ctime and a hash of head
+		and tail; an edit, that keeps size and mtime, changes the ctime"""
+		stat = os.stat(self.name)
+		f = open(self.name, 'rb')
+		digest = hashlib.md5(f.read(self.index_block))
+		f.seek(max(0, stat.st_size - self.index_block))
+		digest.update(f.read(self.index_block))
+		f.close()
+		name = hashlib.md5(os.path.abspath(self.name)).hexdigest()
+		return (Main.prefs.cache(name + '.idx'),
+			(stat.st_size, int(stat.st_mtime), stat.st_ino, stat.st_ctime,
+			digest.hexdigest()))
+
+	def load_index(self):
+		"put games from the index into the book, return False if outdated"
+		try:
+			fn, stat = self.index_stat()
+			f = open(fn, 'rb')
+			magic, version, valid, index = marshal.load(f)
+			f.close()
+		except (IOError, OSError, EOFError, ValueError, TypeError):
+			return False
+		if magic != self.index_magic or version != self.index_version \
+			or valid != stat:
+			return False
+		for name, header, start, end, line, moves, first, last, names \
+			in index:
+			if self.cancelled:
 				break
-			# warn about others
-			print self.error_leader(), 'stray text in movelist: "%s"' %token
-			break
+			self.begin_game()
+			self.record[0] = name
+			self.record[1] = header
+			self.record[4] = (self.source, start, end, line)
+			self.record[6] = [self.source, first, last]
+			self.record[7] = names
+			self.moves += moves
+		self.offset = stat[0]
+		return True
 
-	def parse(self):
-		"parse book: headers, annotation, movelist; hold game.lock"
-		Main.game.lock.acquire()
-		Main.book.do_clear()
-		Main.bookview.connect_model(False)
-		for token in iter(self.get_token, None):
+	def save_index(self):
+		"write the index of the scanned book to the cache"
+		try:
+			fn, stat = self.index_stat()
+			f = open(fn, 'wb')
+			marshal.dump((self.index_magic, self.index_version,
+				stat, self.index), f)
+			f.close()
+		except (IOError, OSError, ValueError):
+			pass
+
+	def parse_book(self):
+		"parse games: headers, annotation, movelist; save them to book"
+		last = None # the move annotations go to, or 'number' for the next
+		annotation = ''
+		for token, text, value in self.tokens():
 			# header
-			if token == '[':
-				self.parse_header()
+			if token == 'header':
+				if not self.pdn_state == 'headers':
+					if self.cancelled:
+						return
+					self.begin_game(self.tell(self.start),
+						self.tell_end(self.start))
+				self.set_header(text, value)
+				last = None
+				continue
+			if not self.record and token != 'stray':
 				continue
 			# annotation
-			elif token == '{':
-				if self.game < 0: continue
-				annotation = self.parse_annotation()
-				Main.book[self.game][Book.COL_ANNO] = annotation
+			if token == 'annotation':
+				if self.pdn_trace:
+					print "A:%s,%s:	{%s}" % (self.game, self.move, text)
+				if last == 'number':
+					annotation = text
+				elif last:
+					last[2] = text
+				else:
+					self.record[2] = text
 				continue
-			# shift movelist
-			elif token[0] in '1234567890*':
-				if not self.pdn_state == 'moves':
-					self.pdn_state = 'moves'
-				self.push_token(token)
-				self.parse_moves()
+			# move number
+			elif token == 'number':
+				self.pdn_state = 'moves'
+				last = 'number'
+				annotation = ''
+				continue
+			# move
+			elif token == 'move':
+				self.pdn_state = 'moves'
+				self.move += 1
+				steps = self.move_split(text)
+				if self.pdn_trace:
+					print "M:%s,%s:	%s" %(self.game, self.move, steps)
+				last = [text, value, annotation, steps]
+				self.record[3].append(last)
+				annotation = ''
+				self.moves += 1
+				continue
+			# result
+			elif token == 'result':
+				self.set_result(text)
+				last = None
 				continue
 			# warn about others
-			print self.error_leader(), 'stray text: "%s"' %token
-		Main.bookview.connect_model(True)
-		Main.game.lock.release()
-		Main.feedback.g_push('read %d games from %s'
-			%(self.game + 1, self.name))
-		if self.game < 0:
+			if self.pdn_state == 'moves':
+				print self.error_leader(), 'stray text in movelist: "%s"' %text
+			else:
+				print self.error_leader(), 'stray text: "%s"' %text
+		if self.record and self.record[6]:
+			self.record[6][2] = self.tell_end(len(self.buf))
+
+	def parse(self, append=False):
+		"""start parsing or scanning the book in a thread, to <append> it
+		to the book or to replace it; hold game.lock, when replacing"""
+		if append:
+			self.first = Main.book.iter_n_children(None)
+		else:
+			Main.game.lock.acquire()
+			self.locked = True
+			Main.book.do_clear()
+		Main.book.loader = self
+		self.lazy = Main.prefs.getint('book', 'lazy')
+		duplicates = Main.prefs.get('book', 'duplicates')
+		if duplicates != 'keep':
+			self.duplicates = duplicates
+		if self.source.text is not None:
+			self.size = len(self.source.text)
+		else:
+			self.size = os.fstat(self.instream.fileno()).st_size
+		Main.feedback.g_push('Loading book: %s' % self.name)
+		assert thread.start_new_thread(self.parse_thread, ())
+
+	def parse_thread(self):
+		"parse or scan book, pass the games on; the stream is closed after"
+		try:
+			if not self.lazy:
+				self.parse_book()
+			elif self.source.text is not None:
+				self.scan()
+			elif not self.load_index():
+				self.scan()
+				if not self.cancelled:
+					self.save_index()
+			self.end_game()
+		finally:
+			self.instream.close()
+			gobject.idle_add(self.insert, self.pending, self.size, True)
+
+	def insert(self, games, offset, done=False):
+		"""put a batch of games into the book, called from gobject idle;
+		the first games in go to the first game of the book and release
+		game.lock; when done, append the following books"""
+		if not self.cancelled:
+			query = Main.bookview.query
+			for game in games:
+				if self.duplicates and self.duplicate(game):
+					continue
+				num = self.first + self.inserted
+				iter = Main.book.pdn_game(num, *game[:8])
+				# appended while searching, the search hides them, or not
+				if query:
+					Main.book.show_game(num, iter, query)
+				self.inserted += 1
+			if self.locked and self.inserted:
+				self.locked = False
+				Main.game.lock.release()
+				Main.game.pdn(self.first + self.inserted - 1)
+			elif self.inserted:
+				Main.game.loaded(self.first + self.inserted - 1)
+		if not done:
+			if not self.cancelled:
+				Main.feedback.g_push('Loading book: %d games, %d%%'
+					%(self.inserted, offset * 100 / max(self.size, 1)))
+			return False
+		Main.book.loader = None
+		if self.locked:
+			self.locked = False
+			Main.game.lock.release()
+		if self.cancelled:
+			Main.feedback.g_push('Loading cancelled, kept %d games from %s'
+				%(self.inserted, self.name))
+		elif self.dropped:
+			Main.feedback.g_push('read %d games, %d moves from %s, %s %d'
+				' duplicates' %(self.inserted, self.moves, self.name,
+				self.duplicates == 'merge' and 'merged' or 'dropped',
+				self.dropped))
+		else:
+			Main.feedback.g_push('read %d games, %d moves from %s'
+				%(self.inserted, self.moves, self.name))
+		if not self.cancelled and self.following \
+			and Main.gui.append_book(self.following):
+			return False
+		if not self.first + self.inserted and not Main.game.lock.locked():
 			Main.game.new()
 			Main.feedback.g_push('No games found')
+		return False
+
+	def duplicate(self, record):
+		"""return True, if the game of <record> is in the book already,
+		merge its headers and annotation there, if asked to"""
+		fingerprint = record[8]
+		num = Main.book.fingerprints.get(fingerprint)
+		if num is None:
+			Main.book.fingerprints[fingerprint] = self.first + self.inserted
 			return False
-		Main.game.pdn(self.game)
+		self.dropped += 1
+		if self.duplicates == 'merge':
+			Main.book.merge_game(num, *record[:3])
+			if Main.bookview.query:
+				Main.book.show_game(num, Main.book.iter_nth_child(None, num),
+					Main.bookview.query)
 		return True
 
+	def cancel(self):
+		"stop the thread at the next game"
+		self.cancelled = True
+
+import struct
+
+class NativeSource(object):
+	"where the moves of the games of a native book are read from"
+
+	def __init__(self, name, data, base, strings):
+		self.name = name
+		self.data = data
+		self.base = base # of the moves
+		self.strings = strings
+
+	def load(self, start, end, line, header):
+		"""unpack the moves from offset <start> to <end>, of a game with
+		<header>; return annotation and moves, as Pdn.parse_body"""
+		data, strings = self.data, self.strings
+		pos, end = self.base + start, self.base + end
+		moves = []
+		while pos < end:
+			flags, count = ord(data[pos]), ord(data[pos + 1])
+			pos += 2
+			steps = [ord(c) for c in data[pos:pos + count]]
+			pos += count
+			annotation = ''
+			if flags & Native.ANNO:
+				annotation = strings[struct.unpack_from('<I', data, pos)[0]]
+				pos += 4
+			if flags & Native.NAME:
+				name = strings[struct.unpack_from('<I', data, pos)[0]]
+				pos += 4
+			else:
+				name = (flags & Native.TAKE and 'x' or '-').join(
+					[str(step) for step in steps])
+			moves.append([name, Native.strengths[flags & 3], annotation,
+				steps])
+		return '', moves
+
+class Native(Pdn):
+	"""load and save the book in the native format of capers
+
+	pdn is for interchange, the native format loads in one pass without
+	a parser, from the map of the file:
+
+	- a head: magic, version, number of games, bytes of strings and moves
+	- a record per game: fifteen 32 bit numbers, little endian: name,
+	  black, white, date, site, round, result, fen and annotation as
+	  indexes into the strings, gametype, start, length and number of
+	  its moves, the hash of the setup, low and high
+	- the strings, each header value, annotation and odd move name only
+	  once, separated by nul
+	- the moves: flags, number of squares, the squares as bytes, then
+	  the indexes of the annotation and name, if the flags say so
+
+	the moves are unpacked when a game is first selected, as for lazily
+	loaded pdn, and the book replays them from idle, for the positions
+	and openings; pdn, saved from the native book, is the same as saved
+	from the book the native one was saved from. NativeWriter saves it
+	"""
+
+	magic = 'CAPERSBK'
+	version = 1
+	head = struct.Struct('<8sIIII')
+	fields = 15
+	strengths = ('', '!', '?', '*')
+	ANNO, TAKE, NAME = 4, 8, 16 # move flags
+	name_re = re.compile(r'\.capers(\.gz|\.bz2|\.xz)?$')
+
+	@staticmethod
+	def sniff(f):
+		"return True, if the file <f> is a native book"
+		magic = f.read(len(Native.magic))
+		f.seek(0)
+		return magic == Native.magic
+
+	@staticmethod
+	def named(name):
+		"return True, if a book saved to <name> is to be native"
+		return bool(Native.name_re.search(name))
+
+	def replay(self, record):
+		"""return the hash of the setup, that is in the record already; the
+		book unpacks and replays the moves"""
+		return record[5] and [record[5]] or []
+
+	def played(self, record):
+		"return the names of the moves of <record>, unpacked, and its result"
+		if not record[4]:
+			return [], record[1]['result']
+		source, start, end, line = record[4]
+		return [move[0] for move in source.load(start, end, line,
+			record[1])[1]], record[1]['result']
+
+	def parse_thread(self):
+		"load book, pass the games on; the stream is closed after"
+		try:
+			self.load()
+			self.end_game()
+		finally:
+			self.instream.close()
+			gobject.idle_add(self.insert, self.pending, self.size, True)
+
+	def load(self):
+		"read the records and strings, the moves are left in the file"
+		data = self.data
+		if data is None:
+			data = self.instream.read()
+		magic, version, games, size, length = self.head.unpack_from(data)
+		if magic != self.magic or version != self.version:
+			print '"%s": not a native book of version %d' \
+				% (self.name, self.version)
+			return
+		pos = self.head.size
+		table = array('I')
+		table.fromstring(data[pos:pos + games * self.fields * 4])
+		if sys.byteorder == 'big':
+			table.byteswap()
+		pos += games * self.fields * 4
+		strings = data[pos:pos + size].split('\0')
+		source = NativeSource(self.name, data, pos + size, strings)
+		columns = [table[i::self.fields] for i in xrange(self.fields)]
+		for name, black, white, date, site, round, result, fen, \
+			annotation, gametype, start, length, moves, low, high \
+			in zip(*columns):
+			if self.cancelled:
+				return
+			self.end_game()
+			self.game += 1
+			self.offset = self.size * self.game / games
+			fen = strings[fen]
+			self.record = [strings[name], {'gametype': gametype,
+				'black': strings[black], 'white': strings[white],
+				'result': strings[result], 'date': strings[date],
+				'site': strings[site], 'round': strings[round],
+				'fen': fen and self.parse_fen(fen)}, strings[annotation],
+				[], moves and (source, start, start + length, 0) or None,
+				low | high << 32, None, None]
+			self.moves += moves
+
+class NativeWriter(object):
+	"save the book in the native format of capers, see Native"
+
+	def __init__(self, stream):
+		self.outstream = stream
+
+	def pack(self, moves, intern):
+		"""return the number of <moves>: name, strength, annotation and them
+		as a string of the native format, strings are numbered by <intern>"""
+		packed = []
+		count = 0
+		for name, strength, annotation in moves:
+			flags = Native.strengths.index(strength or '')
+			if 'x' in name:
+				flags |= Native.TAKE
+			try:
+				steps = [int(x) for x in Pdn.step_re.split(name)]
+			except ValueError:
+				steps = []
+			if not steps or max(steps) > 255 or len(steps) > 255 \
+				or (flags & Native.TAKE and 'x' or '-').join(
+				map(str, steps)) != name:
+				flags |= Native.NAME
+				steps = []
+			if annotation:
+				flags |= Native.ANNO
+			packed.append(chr(flags) + chr(len(steps)) +
+				''.join(map(chr, steps)))
+			if annotation:
+				packed.append(struct.pack('<I', intern(annotation)))
+			if flags & Native.NAME:
+				packed.append(struct.pack('<I', intern(name)))
+			count += 1
+		return count, ''.join(packed)
+
+	def save(self, book):
+		"write all games of <book> to the stream, return how many"
+		strings = {'': 0}
+		table = ['']
+		def intern(text):
+			"return the number of <text> in the strings"
+			text = text.replace('\0', ' ')
+			num = strings.get(text)
+			if num is None:
+				num = strings[text] = len(table)
+				table.append(text)
+			return num
+		records = array('I')
+		moves = []
+		length = 0
+		game = book.get_iter_first()
+		while game:
+			name, header, annotation, movelist = book.read_game(game)
+			count, packed = self.pack(movelist, intern)
+			fen = header['fen']
+			fen = fen and fen[0] and book.fen2str(fen) or ''
+			hash = book.get_value(game, book.COL_HASH) or 0
+			records.extend((intern(name), intern(header['black']),
+				intern(header['white']), intern(header['date']),
+				intern(header['site']), intern(header['round']),
+				intern(header['result']), intern(fen),
+				intern(annotation or ''), header['gametype'], length,
+				len(packed), count, hash & 0xffffffff, hash >> 32))
+			moves.append(packed)
+			length += len(packed)
+			game = book.iter_next(game)
+		if sys.byteorder == 'big':
+			records.byteswap()
+		text = '\0'.join(table)
+		games = len(records) / Native.fields
+		self.outstream.write(Native.head.pack(Native.magic, Native.version,
+			games, len(text), length))
+		self.outstream.write(records.tostring())
+		self.outstream.write(text)
+		for packed in moves:
+			self.outstream.write(packed)
+		return games
+
+try:
+	import sqlite3
+except ImportError:
+	sqlite3 = None
+
+class Database(object):
+	"""games kept in a sqlite file, an optional backend of the book
+
+	the games table has a column per header, event, black, white, result,
+	date and gametype are indexed, and the moves as a pdn movelist; the
+	positions table has the hashes of the setups and of the positions
+	after the moves, indexed, with game and ply. a book is saved to it in
+	one transaction, the rows are inserted in batches; the tables are only
+	created then, a database opened must have them
+
+	the book gets the headers of the games page by page, as the bookview
+	is scrolled down or the next game is asked for; the moves are read
+	when a game is selected, as for lazily loaded pdn. the search of the
+	bookview is a query of all the games, by prefix on the indexes, so it
+	does not scan the table; a value is found by its start only, not by
+	the words inside, as in a book from pdn. the positions of all games
+	are found by the index
+	"""
+
+	magic = 'SQLite format 3\x00'
+	page = 500 # games put into the book at once
+	batch = 1000 # games inserted at once
+	keys = ('event', 'black', 'white', 'result', 'date', 'gametype')
+	name_re = re.compile(r'\.(db|sqlite)$')
+	schema = ("""create table if not exists games (id integer primary key,
+		event text, black text, white text, result text, date text,
+		site text, round text, gametype integer, fen text, annotation text,
+		hash integer, moves integer, movetext text)""",
+		"""create table if not exists positions (hash integer,
+		game integer, ply integer)""",
+		'create index if not exists positions_hash on positions (hash)')
+	columns = """id, event, black, white, result, date, site, round,
+		gametype, fen, annotation, hash, moves"""
+
+	def __init__(self, name, create=False):
+		"""open database <name>, raise sqlite3.Error, if it has not the
+		tables of a book; <create> them, to save a book to it"""
+		self.name = name
+		self.db = sqlite3.connect(name)
+		self.db.text_factory = str
+		try:
+			if create:
+				for sql in self.schema:
+					self.db.execute(sql)
+				for key in self.keys:
+					self.db.execute('create index if not exists games_%s'
+						' on games (%s%s)' % (key, key,
+						key != 'gametype' and ' collate nocase' or ''))
+			self.db.execute('select %s, movetext from games limit 0'
+				% self.columns)
+			self.db.execute('select hash, game, ply from positions limit 0')
+		except sqlite3.Error:
+			self.db.close()
+			raise
+		self.pdn = Pdn('', name) # parses fens and moves
+
+	@staticmethod
+	def sniff(f):
+		"return True, if the file <f> is a database"
+		magic = f.read(len(Database.magic))
+		f.seek(0)
+		return bool(sqlite3) and magic == Database.magic
+
+	@staticmethod
+	def named(name):
+		"return True, if a book saved to <name> is to be a database"
+		return bool(sqlite3) and bool(Database.name_re.search(name))
+
+	def signed(self, hash):
+		"return the unsigned 64 bit <hash> as sqlite keeps it"
+		return (hash ^ 1 << 63) - (1 << 63)
+
+	def query(self, text):
+		"""return the where clause and its arguments for the games, that
+		match all the words of <text>, as for Headers.search; the values
+		start with the words, but for the gametype, that is a number"""
+		where = []
+		args = []
+		for word in text.lower().split():
+			key, colon, prefix = word.partition(':')
+			if colon and key in self.keys:
+				keys = (key,)
+			else:
+				keys, prefix = Headers.words, word
+			if keys == ('gametype',):
+				where.append('gametype = ?')
+				args.append(prefix.isdigit() and int(prefix) or -1)
+				continue
+			# a range on the indexes, that do not mind the case
+			where.append('(%s)' % ' or '.join(['%s >= ? collate nocase'
+				' and %s < ? collate nocase' % (key, key) for key in keys]))
+			args.extend((prefix, prefix + '\xff') * len(keys))
+		if not where:
+			return '', ()
+		return 'where ' + ' and '.join(where), tuple(args)
+
+	def search(self, text):
+		"""return the set of the ids of the games, that match all the
+		words of <text>, None if there are none"""
+		where, args = self.query(text)
+		if not where:
+			return None
+		return set([id for id, in self.db.execute('select id from games '
+			+ where, args)])
+
+	def count(self):
+		"return the number of games"
+		return self.db.execute('select count(*) from games').fetchone()[0]
+
+	def offset(self, id):
+		"return the number of games before game <id>"
+		return self.db.execute('select count(*) from games where id < ?',
+			(id,)).fetchone()[0]
+
+	def games(self, offset, limit):
+		"""return id and record, as Pdn makes them, of <limit> games from
+		<offset>"""
+		games = []
+		for id, event, black, white, result, date, site, round, gametype, \
+			fen, annotation, hash, moves in self.db.execute(
+			'select %s from games order by id limit ? offset ?'
+			% self.columns, (limit, offset)):
+			hash &= 0xffffffffffffffff
+			games.append((id, [event, {'gametype': gametype,
+				'black': black, 'white': white, 'result': result,
+				'date': date, 'site': site, 'round': round,
+				'fen': fen and self.pdn.parse_fen(fen)}, annotation, [],
+				moves and (self, id, id, 0) or None, hash and [hash] or [],
+				None]))
+		return games
+
+	def find(self, hash, rows):
+		"""return game and ply of the positions <hash>, in the games the
+		book has, <rows> maps their ids to the games"""
+		return [(rows[game], ply) for game, ply in self.db.execute(
+			'select game, ply from positions where hash = ?',
+			(self.signed(hash),)) if game in rows]
+
+	def load(self, start, end, line, header):
+		"""read the moves of game <start>, that has <header>; return
+		annotation and moves, as Pdn.parse_body"""
+		movetext, = self.db.execute('select movetext from games where id = ?',
+			(start,)).fetchone()
+		return Pdn(movetext, self.name).parse_body(header)
+
+	def hashes(self, book, game, header, moves):
+		"return the hashes of the setup and the positions of <game>"
+		if not book.get_value(game, book.COL_SRC):
+			hashes = [book.get_value(game, book.COL_HASH)]
+			move = book.iter_children(game)
+			while move:
+				hashes.append(book.get_value(move, book.COL_HASH))
+				move = book.iter_next(move)
+			return hashes
+		try:
+			moves = [[None, None, None, self.pdn.move_split(move[0])]
+				for move in moves]
+		except ValueError:
+			return []
+		return book.replay(header, moves)
+
+	def insert(self, games, positions):
+		"insert a batch of <games> and their <positions>"
+		self.db.executemany('insert into games values (%s)'
+			% ', '.join('?' * 14), games)
+		self.db.executemany('insert into positions values (?, ?, ?)',
+			positions)
+
+	def copy(self, count, last):
+		"""copy the games after id <last> of the attached source database
+		and their positions, numbered on from <count>; return how many"""
+		copied = self.db.execute('insert into games select id - ? + ?, %s,'
+			' movetext from source.games where id > ?'
+			% self.columns.split(',', 1)[1], (last, count, last)).rowcount
+		self.db.execute('insert into positions select hash, game - ? + ?, ply'
+			' from source.positions where game > ?', (last, count, last))
+		return copied
+
+	def save(self, book):
+		"""write all games of <book> in one transaction, return how many;
+		the games of the database of the book, that are not paged in yet,
+		are copied from it after those"""
+		games = []
+		positions = []
+		count = 0
+		source = book.database
+		if source:
+			# ids go up in the order of paging
+			last, = source.db.execute('select min(id) - 1 from games'
+				).fetchone()
+			last = max(book.rows.keys() + [last or 0])
+			self.db.execute('attach database ? as source', (source.name,))
+		with self.db:
+			self.db.execute('delete from games')
+			self.db.execute('delete from positions')
+			game = book.get_iter_first()
+			while game:
+				count += 1
+				name, header, annotation, moves = book.read_game(game)
+				moves = list(moves)
+				hashes = self.hashes(book, game, header, moves)
+				fen = header['fen']
+				fen = fen and fen[0] and book.fen2str(fen) or ''
+				games.append((count, name, header['black'],
+					header['white'], header['result'], header['date'],
+					header['site'], header['round'], header['gametype'],
+					fen, annotation or '',
+					self.signed(hashes and hashes[0] or 0), len(moves),
+					book.movetext(moves)))
+				positions.extend([(self.signed(hashes[ply]), count, ply - 1)
+					for ply in xrange(len(hashes)) if hashes[ply]])
+				if len(games) >= self.batch:
+					self.insert(games, positions)
+					games = []
+					positions = []
+				game = book.iter_next(game)
+			self.insert(games, positions)
+			if source:
+				count += self.copy(count, last)
+		if source:
+			self.db.execute('detach database source')
+		return count
+
+	def close(self):
+		self.db.close()
+
 import pango
 
 class CellRendererWrap(gtk.GenericCellRenderer):
@@ -1388,14 +3458,21 @@ class BookView(gtk.TreeView):
 
 	the book view displays data from several columns of the book model
 	in a single column, collection is done via a celldata function
-	to speed up loading of games, the model is disconnected then
+	to speed up a search, the model is disconnected, while it sets the
+	rows shown; games loaded from pdn are appended to it connected
 
 	it might have been preferable to show the black and white move on
 	the same line, but that seems quite hard and doesnt mix well with
 	annotations
+
+	while a search is on, the view shows a filter of the book, the book
+	and the game still talk in paths of the book, they are converted here
 	"""
 
 	_book = None # for disconnect/reconnect
+	_filter = None # of the book, while searching
+	query = '' # words searched for
+	recurring = False # tell where the positions of moves are
 
 	def __init__(self):
 		"never called, libglade doesnt"
@@ -1436,6 +3513,8 @@ class BookView(gtk.TreeView):
 			header['round'] = egn.get_text()
 			header['result'] = egr.get_text()
 			header['date'] = egd.get_text()
+			model.set_dirty(game)
+			model.headers.changed(path[0])
 			Main.feedback.g_push('Game headers set')
 		else:
 			Main.feedback.g_push('Edit game cancelled')
@@ -1465,6 +3544,7 @@ class BookView(gtk.TreeView):
 			model.set(move, Book.COL_STREN, stren)
 			model.set(move, Book.COL_ANNO,
 				ema.get_text(ema.get_start_iter(), ema.get_end_iter()))
+			model.set_dirty(model.iter_parent(move))
 			Main.feedback.g_push('Move info set')
 		else:
 			Main.feedback.g_push('Edit move cancelled')
@@ -1473,12 +3553,13 @@ class BookView(gtk.TreeView):
 	def on_activate_row(self, treeview, path, column):
 		"on double click on row edit game or move"
 		if Main.board.busy or Main.board.edit: return False
+		path = self.book_path(path)
 		if len(path) == 1:
 			Main.feedback.g_push('Edit game headers')
-			self.edit_game(treeview.get_model(), path)
+			self.edit_game(self._book, path)
 		else:
 			Main.feedback.g_push('Edit move info')
-			self.edit_move(treeview.get_model(), path)
+			self.edit_move(self._book, path)
 		return True
 		
 	def on_change_selection(self, selection):
@@ -1487,13 +3568,14 @@ class BookView(gtk.TreeView):
 		if Main.board.busy or Main.board.edit: return False
 		model, iter = selection.get_selected()
 		if not iter: return False
-		Main.game.goto_game_move(model.get_path(iter))
+		Main.game.goto_game_move(self.book_path(model.get_path(iter)))
 		return True
 		
 	def open(self, book):
 		"connect to the model, install callbacks"
 		self._book = book
 		self.set_model(book)
+		self.recurring = Main.prefs.getint('book', 'recurring')
 		column = gtk.TreeViewColumn('Book')
 		column.set_fixed_width(210)
 		self.append_column(column)
@@ -1506,18 +3588,24 @@ class BookView(gtk.TreeView):
 		self.connect('row-activated', self.on_activate_row)
 		selection = self.get_selection()
 		selection.connect('changed', self.on_change_selection)
+		self.get_vadjustment().connect('value-changed', self.on_scroll)
+
+	def on_scroll(self, adjustment):
+		"near the end of the book, page in more games of a database"
+		if adjustment.value + 2 * adjustment.page_size >= adjustment.upper:
+			Main.game.page_in()
 
 	def do_markup (self, column, cell, model, iter):
 		"add annotation and headers to cells markup"
-		name = model.get_value(iter, model.COL_NAME)
+		name = model.get_value(iter, Book.COL_NAME)
 		name = name.replace('&', '&amp;')
-		if model.get_value(iter, model.COL_TURN) == Position.WHITE:
+		if model.get_value(iter, Book.COL_TURN) == Position.WHITE:
 			norm = '<span foreground="#C0000C">%s</span>'
 			bold = '<b>%s</b>'
 		else:
 			norm = '%s'
 			bold = '<b>%s</b>'
-		header = model.get_value(iter, model.COL_HEAD)
+		header = model.get_value(iter, Book.COL_HEAD)
 		if header:
 			black, white, result = \
 				header['black'], header['white'], header['result']
@@ -1525,21 +3613,93 @@ class BookView(gtk.TreeView):
 				+ '\nWhite: %s' % white + '\nResult: %s' % result
 		else:
 			markup = norm % name
-		stren = model.get_value(iter, model.COL_STREN)
+		stren = model.get_value(iter, Book.COL_STREN)
 		if stren:
 			markup = markup + stren
-		anno = model.get_value(iter, model.COL_ANNO)
+		if self.recurring and not header:
+			others = self.recurs(model, iter)
+			if others:
+				markup = markup + ' <small>(%d)</small>' % others
+		anno = model.get_value(iter, Book.COL_ANNO)
 		if anno:
 			anno = anno.replace('&', '&amp;')
 			markup = markup +  '\n' + anno
 		cell.set_property('markup', markup)
 
+	def recurs(self, model, iter):
+		"return in how many other games the position after move <iter> is"
+		hash = model.get_value(iter, Book.COL_HASH)
+		if not hash:
+			return 0
+		game = self.book_path(model.get_path(iter))[0]
+		games = set([hit[0] for hit in self._book.positions.find(hash)])
+		games.discard(game)
+		return len(games)
+
 	def connect_model(self, toggle=True):
-		"toggle/connect from book"
+		"toggle/connect from book, or from its filter while searching"
 		if toggle == False:
 			self.set_model(None)
 		else:
-			self.set_model(self._book)
+			self.set_model(self._filter or self._book)
+
+	def search(self, text):
+		"""show only the games, whose headers match the words of <text>;
+		the filter looks at a column of the book, not at the headers"""
+		self.query = text
+		games = self._book.search(text)
+		detached = self.get_model() is None
+		self.set_model(None)
+		self._book.show(games)
+		self._filter = None
+		if games is not None:
+			self._filter = self._book.filter_new()
+			self._filter.set_visible_column(Book.COL_SHOW)
+			if self._book.database:
+				if not games and self._book.matched:
+					Main.game.page_in()
+				Main.feedback.g_push('Search: %d games, %d of them paged in'
+					% (len(self._book.matched), self._book.iter_n_children(
+					None) - len(self._book.hidden)))
+			else:
+				Main.feedback.g_push('Search: %d games' % len(games))
+		if detached:
+			return
+		self.connect_model(True)
+		if hasattr(self._book, 'game'):
+			self.scroll_to_cell(self._book.get_path(self._book.game))
+
+	def clear_search(self):
+		"empty the search entry, that shows all games again"
+		Main.gui['Search'].set_text('')
+
+	def book_path(self, path):
+		"return the path into the book of view <path>"
+		if self._filter:
+			return self._filter.convert_path_to_child_path(path)
+		return path
+
+	def view_path(self, path):
+		"return the path into the view of book <path>, None if hidden"
+		if self._filter:
+			return self._filter.convert_child_path_to_path(path)
+		return path
+
+	# the book moves the cursor by its own paths
+	def set_cursor(self, path, *args):
+		path = self.view_path(path)
+		if path is not None:
+			gtk.TreeView.set_cursor(self, path, *args)
+
+	def scroll_to_cell(self, path, *args):
+		path = self.view_path(path)
+		if path is not None:
+			gtk.TreeView.scroll_to_cell(self, path, *args)
+
+	def expand_to_path(self, path):
+		path = self.view_path(path)
+		if path is not None:
+			gtk.TreeView.expand_to_path(self, path)
 gobject.type_register(BookView) # make widget available to libglade
 
 
@@ -1547,8 +3707,10 @@ gobject.type_register(BookView) # make widget available to libglade
 # E N G I N E
 # ===========
 
-from ctypes import cdll, c_int, c_double, c_char_p, c_buffer, Structure
-from ctypes import sizeof, byref
+from ctypes import cdll, c_int, c_double, c_char_p, c_void_p, c_buffer
+from ctypes import Structure, POINTER, sizeof, byref, memmove, memset
+from operator import itemgetter
+import threading
 
 class CBcoor(Structure):
 	"cb api coordinates structure"
@@ -1568,13 +3730,14 @@ class CBmove(Structure):
 class Engine (gobject.GObject):
 	"""interface to the checkers engine dll
 
-	on init this class loads an engine. it also translates between
-	the different data types of the C-api and the python game
+	on init, or when first used, this class loads an engine. it also
+	translates between the different data types of the C-api and the
+	python game
 
 	unlike "enginecommand()" and "islegal()", which return in an
-	instant, the "getmove()" function needs to be in a thread: when
-	its done, it will install game.do_enginemove as an idle task
-	in gtk.
+	instant, the "getmove()" function needs to be in a thread: it
+	writes to a pipe, that gtk watches, whenever the info changed,
+	and when its done, then game.do_enginemove is called at once.
 	
 	getmove will change the game.lock, so feedback can know, when
 	the engine stopped. gtk seems to cycle thread locks, so not
@@ -1587,6 +3750,11 @@ class Engine (gobject.GObject):
 	engines have to conform to the CheckerBoard API by Martin Fierz.
 	engines are written eg. in C, and can be loaded and removed at
 	runtime
+
+	the argument and result types of the CBapi functions are declared
+	once, when the dll is loaded; the board, move and reply buffers of
+	enginecommand and islegal are kept with the engine, boards are
+	filled and moves read through index tables built once per gametype
 	"""
 
 	# game result codes
@@ -1595,14 +3763,43 @@ class Engine (gobject.GObject):
 	LOSS = 2
 	UNKNOWN = 3
 
-	def __init__(self, enginefile):
-		"load a dll, set globals: name, gametype, about, help"
+	# CBapi functions: restype, argtypes
+	prototypes = {
+		'enginecommand': (c_int, [c_char_p, c_char_p]),
+		'islegal': (c_int, [c_void_p, c_int, c_int, c_int, POINTER(CBmove)]),
+		'getmove': (c_int, [c_void_p, c_int, c_double, c_char_p,
+			POINTER(c_int), c_int, c_int, POINTER(CBmove)]),
+		}
+	_tables = {} # gametype: cells, board index table, move number table
+
+	class Search:
+		"a search in the background: game lock, info, playnow, the move"
+
+		def __init__(self, lock, buf, playnow, data):
+			"nothing found yet for <data>: color, maxtime, position"
+			self.lock = lock
+			self.buf = buf
+			self.playnow = playnow
+			self.data = data
+			self.info = ''
+			self.move = None
+			self.watch = self.timer = 0 # gobject sources
+			self.worker = None
+
+	def __init__(self, enginefile, known=None):
+		"""set globals: name, about, help; from <known>, what the registry
+		knows of the dll, then it is loaded on use; else load and ask it"""
 		gobject.GObject.__init__(self)
-		try:
-			self.engine = cdll.LoadLibrary(enginefile)
-		except OSError:
-			Fatal('Invalid engine, please remove:\n\n'
-				+ enginefile)
+		self.file = enginefile
+		self.loaded = False
+		self.searches = []
+		self._board = None
+		self._cbmove = CBmove()
+		self._reply = c_buffer(256) # create_string_buffer
+		if known:
+			self.name, self.about, self.help = known
+			return
+		self.use()
 
 		self.name = self.about = self.help = ''
 		res = self.enginecommand('name')
@@ -1615,6 +3812,21 @@ class Engine (gobject.GObject):
 		if res[0]:
 			self.help = res[1]
 
+	def use(self):
+		"load the dll, unless it is loaded already; return self"
+		if not self.loaded:
+			self.load(self.file)
+		return self
+
+	def load(self, enginefile):
+		"load the dll"
+		try:
+			self.engine = self.bind(cdll.LoadLibrary(enginefile))
+		except OSError:
+			Fatal('Invalid engine, please remove:\n\n'
+				+ enginefile)
+		self.loaded = True
+
 	def get(self, key):
 		"shorthand enginecommand get: gametype..."
 		res = self.enginecommand('get ' + key)
@@ -1622,75 +3834,72 @@ class Engine (gobject.GObject):
 			return res[1]
 		return False
 
-	def cbcoor2num(self, cbcoor):
-		"convert CBapi coordinate structure to board number"
-		x = cbcoor.x
-		y = cbcoor.y
-		if Main.game.gametype == Main.game.ENGLISH:
-			y = 8 - y - 1
-		elif Main.game.gametype == Main.game.MAFIERZ:
-			x = 8 - x - 1
-		return Main.game.coor2num(x, y)
-
-	def pos2cbboard(self, position, board):
-		"""copy position to CBapi board
+	@staticmethod
+	def bind(engine):
+		"declare the types of the CBapi functions of <engine>, return it"
+		for name, (restype, argtypes) in Engine.prototypes.items():
+			function = getattr(engine, name, None)
+			if function:
+				function.restype = restype
+				function.argtypes = argtypes
+		return engine
+
+	def tables(self, position):
+		"""return cells and the index tables of the current gametype,
+		build them on first use: the square of <position> for each cell
+		of the CBapi board, the board number for each CBapi coordinate
 		in CBapi, origin is SW, in capers origin is NW"""
+		gametype = Main.game.gametype
+		tables = self._tables.get(gametype)
+		if tables:
+			return tables
 		cells = 8
-		if Main.game.gametype == Main.game.INTERNL: cells = 10
-
-		if Main.game.gametype == Main.game.ENGLISH:
-			for s in position:
-				v, x, y = s[Position.COL_VAL], \
-					s[Position.COL_X], s[Position.COL_Y]
-				if v:
-					board[x][cells-y-1] = v
-		elif Main.game.gametype == Main.game.MAFIERZ:
-			for s in position:
-				v, x, y = s[Position.COL_VAL], \
-					s[Position.COL_X], s[Position.COL_Y]
-				if v:
-					board[cells-x-1][y] = v
-		else:
-			assert 0 # gametype not supported
+		if len(position) == 100: cells = 10
+		layout = position.layout
+		squares = [0] * (cells * cells)
+		nums = {}
+		for i in xrange(len(layout.coors)):
+			x, y = layout.coors[i]
+			if gametype == Main.game.ENGLISH:
+				x, y = x, cells - y - 1
+			elif gametype == Main.game.MAFIERZ:
+				x, y = cells - x - 1, y
+			else:
+				assert 0 # gametype not supported
+			squares[x * cells + y] = i
+			nums[(x, y)] = layout.nums[i]
+		tables = cells, itemgetter(*squares), nums
+		self._tables[gametype] = tables
+		return tables
+
+	def pos2cbboard(self, position, board):
+		"copy position to CBapi board"
+		cells, squares, nums = self.tables(position)
+		values = array('i', squares(position.values))
+		memmove(board, values.buffer_info()[0], sizeof(board))
 		if 0: # print board
 			squares = "-    wb  WB      "
 			for x in range(cells):
 				print ' '.join([squares[num] for num in board[x]])
 			print
 
-	# int enginecommand(char str[256], char reply[256]);
-	def enginecommand(self, command):
-		"mostly 'get gametype' and 'name'"
-		res = 0
-		buf = c_buffer(256) # create_string_buffer
-
-		argtypes = [c_char_p, c_char_p]
-		res = self.engine.enginecommand(command, buf)
-		return res, buf.value
-
-	# int islegal(int b[8][8], int color, int from, int to,
-	#             struct CBmove *move);
-	def islegal(self, list, color, position, cbmove):
-		"check move in list, return False if illegal, else return list"
+	def cbboard(self, position, board=None):
+		"return a CBapi board with <position>, reuse <board>, if it fits"
 		cells = 8
 		if len(position) == 100: cells = 10
 
-		board = ((c_int * cells) * cells)()
-		color = c_int(color)
-		mfrom = c_int(list[0])
-		mto = c_int(list[-1])
-		cbmove = CBmove()
-
+		if board is None or len(board) != cells:
+			board = ((c_int * cells) * cells)()
 		self.pos2cbboard(position, board)
+		return board
 
-		# call engine
-		argtypes = [(c_int * cells) * cells, c_int, c_int, c_int, CBmove]
-		res = self.engine.islegal(board, color, mfrom, mto, byref(cbmove))
-
-		steps = [self.cbcoor2num(cbmove.mfrom)]
-		for i in range(1, cbmove.jumps):
-			steps.append(self.cbcoor2num(cbmove.path[i]))
-		steps.append(self.cbcoor2num(cbmove.mto))
+	def cbmove2move(self, res, cbmove):
+		"return the result <res> and <cbmove> as [res, steps, new, old, huffs]"
+		nums = self.tables(Main.game._position)[2]
+		jumps = cbmove.jumps
+		steps = [nums.get((cbmove.mfrom.x, cbmove.mfrom.y), 0)]
+		steps.extend([nums.get((c.x, c.y), 0) for c in cbmove.path[1:jumps]])
+		steps.append(nums.get((cbmove.mto.x, cbmove.mto.y), 0))
 
 		# collapse duplicate fields in movelist
 		s = steps[-1]
@@ -1698,83 +3907,441 @@ class Engine (gobject.GObject):
 			if steps[i] == s: del steps[i]
 			else: s = steps[i]
 
-		huffs = []
-		for i in range(cbmove.jumps):
-			huffs.append(self.cbcoor2num(cbmove.mdel[i]))
+		huffs = [nums.get((c.x, c.y), 0) for c in cbmove.mdel[:jumps]]
 		return [res, steps, cbmove.newpiece, cbmove.oldpiece, huffs]
 
-	def showbuf(self, lock, buf):
-		"engine feedback, in timeout, stop when lock lost/released"
-		if not lock.locked():
-			return False
-		if lock != Main.game.lock:
-			return False
-		Main.feedback.e_push(buf.value)
-		return lock.locked()
+	# int enginecommand(char str[256], char reply[256]);
+	def enginecommand(self, command):
+		"mostly 'get gametype' and 'name'"
+		res = self.engine.enginecommand(command, self._reply)
+		return res, self._reply.value
 
-	def playnow(self, lock, playnow):
-		"engine break, in timeout, stop when break or lock lost/released"
-		if not Main.game.engines_loop:
-			playnow.value = 1
-			return False
-		if lock != Main.game.lock:
-			return False
-		return lock.locked()
+	# int islegal(int b[8][8], int color, int from, int to,
+	#             struct CBmove *move);
+	def islegal(self, list, color, position, cbmove):
+		"check move in list, return False if illegal, else return list"
+		self._board = self.cbboard(position, self._board)
+		cbmove = self._cbmove
+		memset(byref(cbmove), 0, sizeof(cbmove))
+
+		# call engine
+		res = self.engine.islegal(self._board, color, list[0], list[-1],
+			byref(cbmove))
+		return self.cbmove2move(res, cbmove)
+
+	def showinfo(self, search, info):
+		"engine feedback, unless the lock of <search> is lost/released"
+		search.info = info
+		if search.lock == Main.game.lock and search.lock.locked():
+			Main.feedback.e_push(info)
+
+	def stop(self):
+		"engine break: tell the searches to play now"
+		for search in self.searches:
+			search.playnow.value = 1
+
+	@staticmethod
+	def watch_info(buf, tell, done):
+		"call <tell> with <buf>, whenever the engine changed it, until <done>"
+		info = ''
+		while not done.wait(0.2):
+			if buf.value != info:
+				info = buf.value
+				tell(info)
 
 	# int getmove(int b[8][8],int color, double maxtime, char str[255],
 	#             int *playnow, int info, int unused, struct CBmove *move);
 	def getmove(self, data):
-		"wraps the threaded call to the engine, always return False"
+		"""start searching a move in the background, lock the game; if
+		the engine searched the position already, pass that on at once"""
 		assert not Main.game.lock.locked()
 		Main.game.lock = thread.allocate_lock()
 		Main.game.lock.acquire()
+		analysis = Main.analyses.get(self, data)
+		if analysis:
+			move, info = analysis
+			Main.feedback.e_push(info)
+			gobject.idle_add(Main.game.do_enginemove,
+				tuple(move) + (Main.game.lock,))
+			return
+		self.search(Main.game.lock, data)
+
+	def found(self, search):
+		"keep the move of <search>, unless it was cut short"
+		if not search.playnow.value:
+			Main.analyses.put(self, search.data, search.move, search.info)
+
+	def search(self, lock, data):
+		"start the thread, watch its pipe"
+		search = self.Search(lock, c_buffer(1024), c_int(0), data)
+		read, write = os.pipe()
+		search.watch = gobject.io_add_watch(read,
+			gobject.IO_IN | gobject.IO_HUP, self.on_search, search)
+		self.searches.append(search)
 		assert thread.start_new_thread(
-			self.getmove_thread, ((Main.game.lock, data)))
+			self.getmove_thread, ((search, data, write)))
 
-	def getmove_thread(self, lock, data):
-		"start searching a move; in a thread"
+	def getmove_thread(self, search, data, pipe):
+		"""search a move; in a thread, write 'i' to <pipe>, when the info
+		changed, and 'd', when done"""
 		color, maxtime, position = data
-		cells = 8
-		if len(position) == 100: cells = 10
+		board = self.cbboard(position)
+		cbmove = CBmove()
+		done = threading.Event()
+		watch = threading.Thread(target=self.watch_info,
+			args=(search.buf, lambda info: os.write(pipe, 'i'), done))
+		watch.start()
+		try:
+			res = self.engine.getmove(board, color, maxtime, search.buf,
+				byref(search.playnow), 0, 0, byref(cbmove))
+			search.move = self.cbmove2move(res, cbmove)
+		finally:
+			done.set()
+			watch.join()
+			os.write(pipe, 'd')
+			os.close(pipe)
+
+	def on_search(self, fd, condition, search):
+		"""the search wrote to its pipe: show the info, or pass the move
+		on to the game; in gobject io watch, return False when done"""
+		events = os.read(fd, 4096)
+		self.showinfo(search, search.buf.value)
+		if events and 'd' not in events:
+			return True
+		os.close(fd)
+		self.searches.remove(search)
+		if search.move is None:
+			Main.game.engine_failed(search.lock,
+				'Engine %s failed' % self.name)
+		else:
+			self.found(search)
+			Main.game.do_enginemove(tuple(search.move) + (search.lock,))
+		return False
+gobject.type_register(Engine) # make widget available to Player ListStore
 
-		board = ((c_int * cells) * cells)()
-		self.pos2cbboard(position, board)
-		color = c_int(color)
-		maxtime = c_double(maxtime)
-		buf = c_buffer(1024) # create_string_buffer
+import multiprocessing
+import _multiprocessing
+import signal
+
+class EngineHost(Engine):
+	"""interface to a checkers engine dll, that searches in worker
+	processes, capers talks to them over pipes
+
+	an engine, that crashes or hangs while searching, only takes its
+	worker down, the game is told and a new worker started, when the
+	engine is asked again. workers are started as needed, up to
+	<processes> per engine, so a search, that lost the game lock, does
+	not keep the engine from searching again. "enginecommand()" and
+	"islegal()" return in an instant, so the dll is loaded here too, as
+	for Engine, and answers them at once
+
+	the workers are forked by the spawner, a process forked itself,
+	when there is no thread yet; it passes their pipes back over its
+	own. the board and the move go over the pipe as the bytes of the
+	ctypes structures; the worker tells, when the engine is loaded,
+	sends the info, when it changed, and is told to play now, all over
+	the pipe, that gtk watches, so there is no thread here and nothing
+	waits. the interface is the one of Engine
+	"""
+
+	grace = 10 # seconds to load and answer, past maxtime when searching
+	spawner = None
+
+	class Spawner:
+		"a process forked, when there is no thread yet, that forks the workers"
+
+		def __init__(self):
+			"start the process"
+			self.conn, conn = multiprocessing.Pipe()
+			process = multiprocessing.Process(target=self.serve, args=(conn,))
+			process.daemon = True
+			process.start()
+			conn.close()
+
+		@staticmethod
+		def serve(conn):
+			"""fork a worker for each engine file asked for, send back its
+			pid and pipe; in the spawner"""
+			while True:
+				try:
+					enginefile = conn.recv()
+				except EOFError:
+					return
+				try:
+					while os.waitpid(-1, os.WNOHANG)[0]:
+						pass # reap the ended
+				except OSError:
+					pass # none left
+				worker, child = multiprocessing.Pipe()
+				pid = os.fork()
+				if not pid:
+					conn.close()
+					worker.close()
+					try:
+						EngineHost.serve(enginefile, child)
+					finally:
+						os._exit(0)
+				child.close()
+				conn.send(pid)
+				_multiprocessing.sendfd(conn.fileno(), worker.fileno())
+				worker.close()
+
+		def spawn(self, enginefile):
+			"return pid and pipe of a new worker, that loads <enginefile>"
+			self.conn.send(enginefile)
+			pid = self.conn.recv()
+			fd = _multiprocessing.recvfd(self.conn.fileno())
+			return pid, _multiprocessing.Connection(fd)
+
+	@staticmethod
+	def start():
+		"""fork the spawner, while there is no thread yet; where there is
+		no fork, the workers start anew"""
+		if os.name != 'nt':
+			EngineHost.spawner = EngineHost.Spawner()
+
+	class Worker:
+		"a process, that loads the engine and searches: its pid and pipe"
+
+		def __init__(self, enginefile):
+			"have the process started, it tells, when the engine is loaded"
+			if EngineHost.spawner:
+				self.pid, self.conn = EngineHost.spawner.spawn(enginefile)
+			else:
+				self.conn, conn = multiprocessing.Pipe()
+				process = multiprocessing.Process(target=EngineHost.serve,
+					args=(enginefile, conn))
+				process.daemon = True
+				process.start()
+				conn.close()
+				self.pid = process.pid
+			self.busy = False
+
+		def stop(self):
+			"end the process"
+			self.conn.close()
+			try:
+				os.kill(self.pid, signal.SIGTERM)
+			except OSError:
+				pass # ended already
+			multiprocessing.active_children() # reap it, if it is ours
+
+	@staticmethod
+	def serve(enginefile, conn):
+		"load the engine, answer the searches asked for on <conn>; in the worker"
+		try:
+			engine = Engine.bind(cdll.LoadLibrary(enginefile))
+		except OSError:
+			conn.send(('error',))
+			return
+		conn.send(('ready',))
+		buf = c_buffer(1024)
 		playnow = c_int(0)
-		info = c_int(0)
-		moreinfo = c_int(0)
 		cbmove = CBmove()
+		while True:
+			try:
+				request = conn.recv()
+			except EOFError:
+				return
+			if request[0] != 'getmove':
+				continue # told to play now, when done already
+			cells, board, color, maxtime = request[1:]
+			board = ((c_int * cells) * cells).from_buffer_copy(board)
+			memset(byref(cbmove), 0, sizeof(cbmove))
+			playnow.value = 0
+			done = threading.Event()
+			watch = threading.Thread(target=Engine.watch_info,
+				args=(buf, lambda info: conn.send(('info', info)), done))
+			listen = threading.Thread(target=EngineHost.listen,
+				args=(conn, playnow, done))
+			watch.start()
+			listen.start()
+			res = engine.getmove(board, color, maxtime, buf,
+				byref(playnow), 0, 0, byref(cbmove))
+			done.set()
+			watch.join()
+			listen.join()
+			conn.send((res, buffer(cbmove)[:]))
+
+	@staticmethod
+	def listen(conn, playnow, done):
+		"set <playnow>, when told so on <conn>, until <done>; in the worker"
+		while not done.is_set():
+			try:
+				if conn.poll(0.2) and conn.recv()[0] == 'playnow':
+					playnow.value = 1
+			except (EOFError, IOError):
+				playnow.value = 1 # capers is gone
+				return
 
-		# let main thread handle feedback, break
-		gobject.timeout_add(200, self.showbuf, lock, buf)
-		gobject.timeout_add(100, self.playnow, lock, playnow)
+	def load(self, enginefile):
+		"load the dll, it answers enginecommand and islegal"
+		Engine.load(self, enginefile)
+		self.processes = Main.prefs.getint('engines', 'processes')
+		self.workers = []
+
+	def worker(self):
+		"""return an idle worker, marked busy, start one, if there is
+		none; None if <processes> are busy already"""
+		for worker in self.workers:
+			if not worker.busy:
+				break
+		else:
+			if len(self.workers) >= self.processes:
+				return None
+			worker = self.Worker(self.file)
+			self.workers.append(worker)
+		worker.busy = True
+		return worker
+
+	def drop(self, worker):
+		"end a <worker>, that died or hung"
+		self.workers.remove(worker)
+		worker.stop()
+
+	def stop(self):
+		"engine break: tell the workers searching to play now"
+		for search in self.searches:
+			search.playnow.value = 1
+			try:
+				search.worker.conn.send(('playnow',))
+			except IOError:
+				pass # the watch sees the pipe closed
 
-		argtypes = [(c_int * cells) * cells, c_double, c_char_p,
-			c_int, c_int, c_int, CBmove]
-		res = self.engine.getmove(board, color, maxtime, buf,
-			byref(playnow), info, moreinfo, byref(cbmove))
+	def search(self, lock, data):
+		"start searching a move in a worker, watch its pipe"
+		color, maxtime, position = data
+		board = self.cbboard(position)
+		try:
+			worker = self.worker()
+		except (EnvironmentError, EOFError):
+			worker = None # the spawner is gone
+		if not worker:
+			gobject.idle_add(Main.game.engine_failed, lock,
+				'Engine %s is busy' % self.name)
+			return
+		search = self.Search(lock, None, c_int(0), data)
+		search.worker = worker
+		try:
+			worker.conn.send(('getmove', len(board), buffer(board)[:], color,
+				maxtime))
+		except IOError:
+			pass # the watch sees the pipe closed
+		search.watch = gobject.io_add_watch(worker.conn.fileno(),
+			gobject.IO_IN | gobject.IO_HUP, self.on_reply, search)
+		search.timer = gobject.timeout_add(
+			int((maxtime + self.grace) * 1000), self.on_hung, search)
+		self.searches.append(search)
+
+	def on_reply(self, fd, condition, search):
+		"""the worker sent that the engine is loaded, the info or the move:
+		show the info, or pass the move on to the game; in gobject io
+		watch, return False when done"""
+		worker = search.worker
+		try:
+			reply = worker.conn.recv()
+		except (EOFError, IOError):
+			reply = None
+		if reply == ('ready',):
+			return True
+		if reply and reply[0] == 'info':
+			self.showinfo(search, reply[1])
+			return True
+		gobject.source_remove(search.timer)
+		self.searches.remove(search)
+		if reply is None or reply == ('error',):
+			self.drop(worker)
+			Main.game.engine_failed(search.lock,
+				'Engine %s failed, it is started anew' % self.name)
+			return False
+		worker.busy = False
+		res, cbmove = reply
+		search.move = self.cbmove2move(res, CBmove.from_buffer_copy(cbmove))
+		self.found(search)
+		Main.game.do_enginemove(tuple(search.move) + (search.lock,))
+		return False
 
-		steps = [self.cbcoor2num(cbmove.mfrom)]
-		for i in range(1, cbmove.jumps):
-			steps.append(self.cbcoor2num(cbmove.path[i]))
-		steps.append(self.cbcoor2num(cbmove.mto))
+	def on_hung(self, search):
+		"""the worker did not send the move in time: end it; in gobject
+		timeout, always return False"""
+		gobject.source_remove(search.watch)
+		self.searches.remove(search)
+		self.drop(search.worker)
+		Main.game.engine_failed(search.lock,
+			'Engine %s hung, it is started anew' % self.name)
+		return False
+gobject.type_register(EngineHost) # make widget available to Player ListStore
 
-		# collapse duplicate fields in movelist
-		s = steps[-1]
-		for i in range(len(steps)-2, -1, -1):
-			if steps[i] == s: del steps[i]
-			else: s = steps[i]
+class Analyses(object):
+	"""the moves the engines found last, with their info
 
-		huffs = []
-		for i in range(cbmove.jumps):
-			huffs.append(self.cbcoor2num(cbmove.mdel[i]))
+	an engine asked again, in a position it searched already, with the
+	same maxtime, is answered from here at once; the key is the file and
+	name of the engine, the gametype, the hash of the position, the color
+	to move and maxtime. searches cut short by a break are not kept
 
-		# let main thread handle the move
-		gobject.idle_add(Main.game.do_enginemove,
-			(res, steps, cbmove.newpiece, cbmove.oldpiece, huffs, lock))
-gobject.type_register(Engine) # make widget available to Player ListStore
+	only the <size> analyses used last are kept in memory; with <store>,
+	they also go to a sqlite file in the cache, to be there after a
+	restart
+	"""
+
+	def __init__(self):
+		self.size = Main.prefs.getint('engines', 'analyses')
+		self.analyses = OrderedDict() # key: move, info
+		self.db = None
+		if sqlite3 and self.size and Main.prefs.getint('engines', 'store'):
+			try:
+				self.db = sqlite3.connect(Main.prefs.cache('analyses.db'))
+				self.db.execute('create table if not exists analyses '
+					'(key text primary key, analysis blob)')
+			except sqlite3.Error:
+				self.db = None
+
+	def key(self, engine, data):
+		"return the key of <engine> searching <data>: color, maxtime, position"
+		color, maxtime, position = data
+		return hashlib.md5(repr((engine.file, engine.name, Main.game.gametype,
+			position.key(color), color, maxtime))).hexdigest()
+
+	def get(self, engine, data):
+		"return move and info of <engine> searching <data>, None if not known"
+		if not self.size:
+			return None
+		key = self.key(engine, data)
+		analysis = self.analyses.pop(key, None)
+		if analysis is None and self.db:
+			try:
+				row = self.db.execute('select analysis from analyses '
+					'where key = ?', (key,)).fetchone()
+				if row:
+					analysis = marshal.loads(str(row[0]))
+			except (sqlite3.Error, EOFError, ValueError, TypeError):
+				pass
+		if analysis is None:
+			return None
+		self.keep(key, analysis)
+		return analysis
+
+	def put(self, engine, data, move, info):
+		"keep move and info of <engine> searching <data>"
+		if not self.size:
+			return
+		key = self.key(engine, data)
+		self.keep(key, (move, info))
+		if self.db:
+			try:
+				self.db.execute('insert or replace into analyses '
+					'values (?, ?)', (key, buffer(marshal.dumps((move, info)))))
+				self.db.commit()
+			except sqlite3.Error:
+				pass
+
+	def keep(self, key, analysis):
+		"keep <analysis> in memory, drop the one used longest ago"
+		self.analyses.pop(key, None)
+		self.analyses[key] = analysis
+		if len(self.analyses) > self.size:
+			self.analyses.popitem(False)
 
 # =========
 # B O A R D
@@ -1799,6 +4366,10 @@ class CheckerBoard(gnome.canvas.Canvas):
 	passed when a new board is setup
 
 	the board resizes itself to match the setup, and flips, if asked
+
+	the pieces on the canvas are kept in piecemap, by square number;
+	positions only hold values, so on a switch of position, pieces are
+	reused for the occupied squares, spare ones are hidden
 	
 	self.busy is true, while a piece is moved by user or engine
 	"""
@@ -1809,6 +4380,7 @@ class CheckerBoard(gnome.canvas.Canvas):
 	_temp_move = []
 	_gametype = 0
 	_flipped = False # True when upsidedown
+	piecemap = {} # num: piece
 	_x1 = _y1 = 0 # drag start point
 	busy = False # True while move_piece
 	edit = False # True while editing
@@ -1866,10 +4438,10 @@ class CheckerBoard(gnome.canvas.Canvas):
 		figures = [0, 0, 0, 0, 0, 1, 1, 0, 0, 1, 1, 0, 0, 0, 0, 0, 0]
 		pixbufs = [0, 0, 0, 0, 0,wm,bm, 0, 0,wk,bk, 0, 0, 0, 0, 0, 0]
 		self.pixbufs = pixbufs
-		i = 0
-		for s in setup:
-			n, v, x, y = s[Position.COL_NUM], s[Position.COL_VAL], \
-				s[Position.COL_X], s[Position.COL_Y]
+		self.piecemap = {}
+		nums, coors = setup.layout.nums, setup.layout.coors
+		for i in xrange(len(setup)):
+			n, v, (x, y) = nums[i], setup.values[i], coors[i]
 			# background
 			pb.copy_area(squares[v] * gw,
 				0, gw, gw, bg, x * gw, y * gw)
@@ -1883,8 +4455,7 @@ class CheckerBoard(gnome.canvas.Canvas):
 				p = self.pieces.add(gnome.canvas.CanvasPixbuf)
 				p.set(pixbuf=pixbufs[v], x=x * gw, y=y * gw)
 				p.connect('event', self.on_piece_event)
-				setup[i][Position.COL_PIECE] = p
-			i += 1
+				self.piecemap[n] = p
 		self.connect('event', self.on_board_event)
 		self.background.set(pixbuf=bg)
 		del pb, bg, squares, figures, m, p
@@ -1916,18 +4487,30 @@ class CheckerBoard(gnome.canvas.Canvas):
 		figures = [0, 0, 0, 0, 0, 1, 1, 0, 0, 1, 1, 0, 0, 0, 0, 0, 0]
 		gw = self._grid_width
 		bw = self._board_width
-		for s in setup:
-			n, v, x, y, p = s[Position.COL_NUM], s[Position.COL_VAL], \
-				s[Position.COL_X], s[Position.COL_Y], s[Position.COL_PIECE]
-			if figures[v]:
-				if self._flipped:
-					x, y = p.w2i(bw - x * gw - gw, bw - y * gw - gw)
-				else:
-					x, y = p.w2i(x * gw, y * gw)
-				p.set(pixbuf=self.pixbufs[v], x=x, y=y)
-				p.show()
-			elif p:
-				p.hide()
+		pieces = self.pieces.item_list
+		self.piecemap = {}
+		nums, coors = setup.layout.nums, setup.layout.coors
+		j = 0
+		for i in xrange(len(setup)):
+			v = setup.values[i]
+			if not figures[v]:
+				continue
+			n, (x, y) = nums[i], coors[i]
+			if j < len(pieces):
+				p = pieces[j]
+			else:
+				p = self.pieces.add(gnome.canvas.CanvasPixbuf)
+				p.connect('event', self.on_piece_event)
+			j += 1
+			if self._flipped:
+				x, y = p.w2i(bw - x * gw - gw, bw - y * gw - gw)
+			else:
+				x, y = p.w2i(x * gw, y * gw)
+			p.set(pixbuf=self.pixbufs[v], x=x, y=y)
+			p.show()
+			self.piecemap[n] = p
+		for p in pieces[j:]:
+			p.hide()
 		#self.update_now()
 
 	def on_board_event(self, num, event):
@@ -2033,6 +4616,7 @@ class CheckerBoard(gnome.canvas.Canvas):
 			x, y = piece.w2i(x, y)
 			piece.set(x=x, y=y)
 			self._x1 = self._y1 = 0
+			self.shift_piece(self._temp_move[0], num)
 			Main.game.do_usermove(self._temp_move, legal)
 			self.busy = False
 			return True
@@ -2056,18 +4640,20 @@ class CheckerBoard(gnome.canvas.Canvas):
 
 	def take_piece(self, num):
 		"hide piece on square <num>"
-		piece = Main.game.num2piece(num)
+		piece = self.piecemap.pop(num, None)
 		assert piece
 		piece.hide()
 		self.update_now()
 
 	def set_piece(self, num, value):
 		"make piece on square <num> of <value>, return new piece"
-		piece = Main.game.num2piece(num)
+		piece = self.piecemap.get(num)
 		if not self.edit:
 			assert piece
 		if not value:
-			piece.destroy()
+			if piece:
+				piece.destroy()
+				del self.piecemap[num]
 			return 0
 		elif not piece:
 			piece = self.pieces.add(gnome.canvas.CanvasPixbuf)
@@ -2075,10 +4661,29 @@ class CheckerBoard(gnome.canvas.Canvas):
 			gw = self._grid_width
 			piece.set(pixbuf=self.pixbufs[value], x=x * gw, y=y * gw)
 			piece.connect('event', self.on_piece_event)
+			self.piecemap[num] = piece
 		else:
 			piece.set(pixbuf=self.pixbufs[value])
 		return piece
 
+	def shift_piece(self, a, b):
+		"piece on square <a> is now on square <b>, update piecemap"
+		if a != b:
+			self.piecemap[b] = self.piecemap.pop(a)
+
+	def clear_pieces(self):
+		"destroy all pieces, needed for edit empty"
+		for p in self.pieces.item_list:
+			p.destroy()
+		self.piecemap = {}
+
+	def clean_pieces(self):
+		"destroy all hidden pieces, needed for edit"
+		shown = self.piecemap.values()
+		for p in self.pieces.item_list:
+			if p not in shown:
+				p.destroy()
+
 	def move_piece(self, a, b,):
 		"animate move, set board to 'busy'"
 		def step(x, y):
@@ -2090,7 +4695,7 @@ class CheckerBoard(gnome.canvas.Canvas):
 				if i > abs(x): u = 0
 				if i > abs(y): v = 0
 				yield((u, v))
-		piece = Main.game.num2piece(a)
+		piece = self.piecemap.get(a)
 		assert piece
 		self.busy = True
 		piece.raise_to_top()
@@ -2104,6 +4709,7 @@ class CheckerBoard(gnome.canvas.Canvas):
 		for u, v in step((x2 - x1) * gw, (y2 - y1) * gw):
 			piece.move(u, v)
 			self.update_now()
+		self.shift_piece(a, b)
 		self.busy = False
 
 	def move_piece2(self, a, b):
@@ -2126,9 +4732,10 @@ class CheckerBoard(gnome.canvas.Canvas):
 			self.busy = True
 			gobject.idle_add(step(x, y).next)
 			yield False
-		piece = Main.game.num2piece(a)
+		piece = self.piecemap.get(a)
 		assert piece
 		piece.raise_to_top()
+		self.shift_piece(a, b)
 		gw = self._grid_width
 		x1, y1 = Main.game.num2coor(a)
 		x2, y2 = Main.game.num2coor(b)
@@ -2150,8 +4757,15 @@ class Players(gtk.ListStore):
 
 	subclasses liststore, to be suitable as a model for the engines
 	popup in the "New..." dialogue
+
+	what the engines tell about themselves is kept in a registry in the
+	cache, by file, as long as the file has the same size and mtime; an
+	engine the registry knows is only loaded, when a game needs it
 	"""
 
+	registry_magic = 'capers engine registry'
+	registry_version = 1
+
 	COL_FILE = 0
 	COL_NAME = 1
 	COL_GAMETYPE = 2
@@ -2176,15 +4790,34 @@ class Players(gtk.ListStore):
 			search = os.path.join(libdir, '*.so')
 		engines = glob.glob(search)
 
+		host = Main.prefs.getint('engines', 'host')
+		registry = self.registry_load()
+		known = {}
 		for fn in engines:
-			engine = Engine(fn)
 			try:
-				name, about, help = engine.name, \
-					engine.about, engine.help
-				gametype = int(engine.get('gametype'))
-			except:
-				del engine
-				continue
+				stat = os.stat(fn)
+				valid = stat.st_size, int(stat.st_mtime)
+			except OSError:
+				valid = None
+			if valid and fn in registry and registry[fn][0] == valid:
+				name, about, help, gametype = registry[fn][1]
+				if host:
+					engine = EngineHost(fn, (name, about, help))
+				else:
+					engine = Engine(fn, (name, about, help))
+			else:
+				if host:
+					engine = EngineHost(fn)
+				else:
+					engine = Engine(fn)
+				try:
+					name, about, help = engine.name, \
+						engine.about, engine.help
+					gametype = int(engine.get('gametype'))
+				except:
+					del engine
+					continue
+			known[fn] = valid, (name, about, help, gametype)
 			if gametype == Main.game.INTERNL:
 				gamename = 'International'
 			elif gametype == Main.game.ENGLISH:
@@ -2198,6 +4831,32 @@ class Players(gtk.ListStore):
 			assert gamename
 			self.append([fn, name, gametype, gamename,
 				about, help, engine])
+		if known != registry:
+			self.registry_save(known)
+
+	def registry_load(self):
+		"""return the registry from the cache: file: (size, mtime),
+		(name, about, help, gametype); empty if there is none"""
+		try:
+			f = open(Main.prefs.cache('engines.reg'), 'rb')
+			magic, version, registry = marshal.load(f)
+			f.close()
+		except (IOError, OSError, EOFError, ValueError, TypeError):
+			return {}
+		if magic != self.registry_magic \
+			or version != self.registry_version:
+			return {}
+		return registry
+
+	def registry_save(self, registry):
+		"write the <registry> of the engines to the cache"
+		try:
+			f = open(Main.prefs.cache('engines.reg'), 'wb')
+			marshal.dump((self.registry_magic, self.registry_version,
+				registry), f)
+			f.close()
+		except (IOError, OSError, ValueError):
+			pass
 
 	# convenience
 	def gt2engine(self, gametype):
@@ -2205,7 +4864,7 @@ class Players(gtk.ListStore):
 		iter = self.get_iter_first()
 		while iter:
 			if self.get_value(iter, self.COL_GAMETYPE) == gametype:
-				return self.get_value(iter, self.COL_ENGINE)
+				return self.get_value(iter, self.COL_ENGINE).use()
 			iter = self.iter_next(iter)
 		assert 0
 
@@ -2214,7 +4873,8 @@ class Players(gtk.ListStore):
 		iter = self.get_iter_first()
 		while iter:
 			if self.get_value(iter, self.COL_FILE) == filename:
-				return self.get_value(iter, self.COL_ENGINE)
+				engine = self.get_value(iter, self.COL_ENGINE)
+				return engine and engine.use()
 			iter = self.iter_next(iter)
 		assert 0
 
@@ -2232,7 +4892,8 @@ class Players(gtk.ListStore):
 		iter = self.get_iter_first()
 		while iter:
 			if self.get_value(iter, self.COL_NAME) == name:
-				return self.get_value(iter, self.COL_ENGINE)
+				engine = self.get_value(iter, self.COL_ENGINE)
+				return engine and engine.use()
 			iter = self.iter_next(iter)
 		return None
 
@@ -2418,6 +5079,8 @@ class GladeGui:
 		GtkTreeView=BookView,
 		GtkDialog=NewDialog,
 		GtkStatusbar=Feedback)
+	# a book, that cannot be saved, is told, and its part removed
+	save_errors = (EnvironmentError,) + (sqlite3 and (sqlite3.Error,) or ())
 
 	def __getitem__(self, key):
 		"Make widgets available as attributes of this class"
@@ -2484,6 +5147,22 @@ class GladeGui:
 		action.connect_accelerator()
 		menu.append(action.create_menu_item())
 
+		action = gtk.Action('find', '_Find position', \
+			'Find position in book', gtk.STOCK_FIND)
+		action.connect('activate', self.find_cb)
+		actiongroup.add_action_with_accel(action, '<control>f')
+		action.set_accel_group(accelgroup)
+		action.connect_accelerator()
+		menu.append(action.create_menu_item())
+
+		action = gtk.Action('explore', 'Open_ings', \
+			'Replies played in book', None)
+		action.connect('activate', self.explore_cb)
+		actiongroup.add_action_with_accel(action, '<control>i')
+		action.set_accel_group(accelgroup)
+		action.connect_accelerator()
+		menu.append(action.create_menu_item())
+
 		action = gtk.Action('open', '_Open book', 'Open book', gtk.STOCK_OPEN)
 		action.connect('activate', self.open_cb)
 		actiongroup.add_action_with_accel(action, None)
@@ -2499,6 +5178,14 @@ class GladeGui:
 		action.set_accel_group(accelgroup)
 		action.connect_accelerator()
 		menu.append(action.create_menu_item())
+
+		action = gtk.Action('savebook', 'Save _book', 'Save book',
+			gtk.STOCK_SAVE_AS)
+		action.connect('activate', self.savebook_cb)
+		actiongroup.add_action_with_accel(action, None)
+		action.set_accel_group(accelgroup)
+		action.connect_accelerator()
+		menu.append(action.create_menu_item())
 		
 		sep = gtk.SeparatorMenuItem()
 		sep.show()
@@ -2534,12 +5221,12 @@ class GladeGui:
 
 	def new_cb(self, *args):
 		"new same game"
-		if not Main.game.lock.locked():
+		if not Main.game.lock.locked() and not Main.book.loader:
 			Main.game.new()
 
 	def nwo_cb(self, *args):
 		"new game with options"
-		if Main.game.lock.locked():
+		if Main.game.lock.locked() or Main.book.loader:
 			Main.feedback.g_push('Function locked!')
 			return
 		Main.feedback.g_push('Select options for new game...')
@@ -2555,7 +5242,7 @@ class GladeGui:
 
 	def open_cb(self, *args):
 		"load book from pdn file"
-		if Main.game.lock.locked():
+		if Main.game.lock.locked() or Main.book.loader:
 			return
 		Main.feedback.g_push('Select book to open...')
 		fc = gtk.FileChooserDialog(title='Open...',
@@ -2566,6 +5253,12 @@ class GladeGui:
 		filter = gtk.FileFilter()
 		filter.set_name("Checkers Books")
 		filter.add_pattern("*.pdn")
+		filter.add_pattern("*.pdn.gz")
+		filter.add_pattern("*.pdn.bz2")
+		filter.add_pattern("*.pdn.xz")
+		filter.add_pattern("*.capers")
+		filter.add_pattern("*.db")
+		filter.add_pattern("*.sqlite")
 		filter.add_mime_type("text/*")
 		fc.add_filter(filter)
 		filter = gtk.FileFilter()
@@ -2574,17 +5267,17 @@ class GladeGui:
 		fc.add_filter(filter)
 		opendir = Main.prefs.get('paths', 'opengame')
 		fc.set_current_folder(opendir)
+		fc.set_select_multiple(True)
 		if fc.run() == gtk.RESPONSE_OK:
-			fn = fc.get_filename()
+			fns = fc.get_filenames()
+			fn = fns[0]
 			try:
-				f = open(fn, 'r')
+				f = PdnStream.open(fn)
 			except:
 				Main.feedback.g_push('Could not open file')
 				fc.destroy()
 				return
-			pdn = Pdn(f, fn)
-			pdn.parse()
-			f.close()
+			self.open_book(f, fn, fns[1:])
 			# save path
 			opendir = os.path.dirname(fn)
 			Main.prefs.set('paths', 'opengame', opendir)
@@ -2593,6 +5286,49 @@ class GladeGui:
 			Main.feedback.g_push('Open book cancelled')
 		fc.destroy()
 
+	def open_book(self, f, fn, following=(), append=False):
+		"""load book from file <f>, named <fn>: a database, native or pdn;
+		the books named <following> are appended after, not to a database"""
+		if Database.sniff(f):
+			f.close()
+			try:
+				database = Database(fn)
+			except sqlite3.Error:
+				Main.feedback.g_push('Not a book of capers: %s' % fn)
+				if not Main.book.iter_n_children(None):
+					Main.game.new()
+				return
+			if Main.book.open_database(database):
+				Main.game.pdn(Main.book.iter_n_children(None) - 1)
+			else:
+				Main.game.new()
+			Main.feedback.g_push('read %d of %d games from %s'
+				%(Main.book.paged, database.count(), fn))
+			return
+		if Native.sniff(f):
+			pdn = Native(f, fn)
+		else:
+			pdn = Pdn(f, fn)
+		pdn.following = following
+		pdn.parse(append)
+
+	def append_book(self, fns):
+		"""append the first book of <fns>, that is no database, to the
+		book, the others after it; return False, if there is none"""
+		for i in xrange(len(fns)):
+			try:
+				f = PdnStream.open(fns[i])
+			except:
+				Main.feedback.g_push('Could not open %s' % fns[i])
+				continue
+			if Database.sniff(f):
+				f.close()
+				Main.feedback.g_push('Not appended, a database: %s' % fns[i])
+				continue
+			self.open_book(f, fns[i], fns[i + 1:], True)
+			return True
+		return False
+
 	def save_cb(self, *args):
 		"save current game as pdn"
 		if Main.game.lock.locked():
@@ -2606,6 +5342,9 @@ class GladeGui:
 		filter = gtk.FileFilter()
 		filter.set_name("Checkers Books")
 		filter.add_pattern("*.pdn")
+		filter.add_pattern("*.pdn.gz")
+		filter.add_pattern("*.pdn.bz2")
+		filter.add_pattern("*.pdn.xz")
 		filter.add_mime_type("text/*")
 		fc.add_filter(filter)
 		filter = gtk.FileFilter()
@@ -2619,9 +5358,9 @@ class GladeGui:
 		fc.set_current_folder(savedir)
 		if fc.run() == gtk.RESPONSE_OK:
 			fn = fc.get_filename()
-			f = open(fn, 'w')
+			f = PdnStream.create(fn)
 			f.write(text)
-			f.close
+			f.close()
 			# save path
 			savedir = os.path.dirname(fn)
 			Main.prefs.set('paths', 'savegame', savedir)
@@ -2631,6 +5370,62 @@ class GladeGui:
 			Main.feedback.g_push('Save game cancelled')
 		fc.destroy()
 
+	def savebook_cb(self, *args):
+		"save all games in the book as pdn"
+		if Main.game.lock.locked() or Main.book.loader:
+			return
+		Main.feedback.g_push('Select file for saving book...')
+		fc = gtk.FileChooserDialog(title='Save book as...',
+			action=gtk.FILE_CHOOSER_ACTION_SAVE,
+			buttons=(gtk.STOCK_CANCEL, gtk.RESPONSE_CANCEL,
+			gtk.STOCK_SAVE, gtk.RESPONSE_OK))
+		fc.set_default_response(gtk.RESPONSE_OK)
+		filter = gtk.FileFilter()
+		filter.set_name("Checkers Books")
+		filter.add_pattern("*.pdn")
+		filter.add_pattern("*.pdn.gz")
+		filter.add_pattern("*.pdn.bz2")
+		filter.add_pattern("*.pdn.xz")
+		filter.add_pattern("*.capers")
+		filter.add_pattern("*.db")
+		filter.add_pattern("*.sqlite")
+		filter.add_mime_type("text/*")
+		fc.add_filter(filter)
+		fc.set_current_name('book.pdn')
+		savedir = Main.prefs.get('paths', 'savegame')
+		fc.set_current_folder(savedir)
+		if fc.run() == gtk.RESPONSE_OK:
+			fn = fc.get_filename()
+			# games may be copied from the file, replace it when done
+			f = None
+			try:
+				if Database.named(fn):
+					f = Database(fn + '.part', True)
+					count = f.save(Main.book)
+				elif Native.named(fn):
+					f = PdnStream.create(fn, fn + '.part')
+					count = NativeWriter(f).save(Main.book)
+				else:
+					f = PdnStream.create(fn, fn + '.part')
+					count = Main.book.write_book(f)
+				f.close()
+				os.rename(fn + '.part', fn)
+			except self.save_errors, e:
+				if f:
+					f.close()
+				if os.path.exists(fn + '.part'):
+					os.remove(fn + '.part')
+				Main.feedback.g_push('Book not saved: %s' % e)
+			else:
+				savedir = os.path.dirname(fn)
+				Main.prefs.set('paths', 'savegame', savedir)
+				Main.prefs.save()
+				Main.feedback.g_push('Book saved: %d games to %s'
+					% (count, fn))
+		else:
+			Main.feedback.g_push('Save book cancelled')
+		fc.destroy()
+
 	def copy_cb(self, *args):
 		"copy game"
 		if Main.game.lock.locked():
@@ -2642,7 +5437,7 @@ class GladeGui:
 
 	def paste_cb(self, *args):
 		"paste game"
-		if Main.game.lock.locked():
+		if Main.game.lock.locked() or Main.book.loader:
 			return
 		Main.feedback.g_push('Paste book from clipboard')
 		text = self.clipboard.wait_for_text()
@@ -2652,9 +5447,26 @@ class GladeGui:
 		pdn = Pdn(text, 'clipboard')
 		pdn.parse()
 
+	def find_cb(self, *args):
+		"go to the next game with the position on the board"
+		if Main.game.lock.locked():
+			return
+		Main.game.find_position()
+
+	def explore_cb(self, *args):
+		"show the replies played in the book at the position on the board"
+		if Main.game.lock.locked():
+			return
+		Main.game.explore()
+
 	def edit_cb(self, *args):
 		"edit board toggle"
 		action = self.actiongroup.get_action('edit')
+		# the editor adds a game, not while the book loads
+		if not Main.board.edit and Main.book.loader:
+			if action.get_active():
+				action.set_active(False)
+			return
 		if Main.board.edit:
 			Main.game.stop_edit()
 			Main.board.edit = False
@@ -2701,8 +5513,12 @@ class GladeGui:
 	def on_button_go(widget):
 		Main.game.engines_go()
 	def on_button_stop(widget):
+		Main.book.cancel_load()
 		Main.game.engines_stop()
 
+	def on_search_changed(widget):
+		Main.bookview.search(widget.get_text())
+
 
 # =========
 # P R E F S
@@ -2716,7 +5532,13 @@ class Prefs(ConfigParser.RawConfigParser):
 	- the player has a name
 	- the game has a gametype, a black and a white player
 	  players may be "human" or the path to an engine
+	- the engines may be hosted in worker processes, some per engine;
+	  the analyses of the positions searched last are kept, on disk too,
+	  if they are to be stored
 	- the look has a scene and a glade file
+	- the book may be loaded lazily, game by game; games appended, that
+	  it has already, may be kept, dropped or merged; the moves may
+	  tell, in how many other games their position is
 
 	this is just the last game played, no checking is done, if
 	engine and gametype match; prefs are synced from "New..."
@@ -2750,6 +5572,20 @@ class Prefs(ConfigParser.RawConfigParser):
 		self.pmkdir(prefsdir)
 		return os.path.join(prefsdir, 'prefs')
 
+	def cache(self, name):
+		"""return filename <name> in the cache directory, that is
+		$XDG_CACHE_HOME/capers or $HOME/.cache/capers"""
+		cachedir = os.getenv('XDG_CACHE_HOME')
+		if not cachedir:
+			cachedir = os.getenv('HOME')
+			if cachedir:
+				cachedir = os.path.join(cachedir, '.cache')
+			else:
+				cachedir = os.getcwd()
+		cachedir = os.path.join(cachedir, 'capers')
+		self.pmkdir(cachedir)
+		return os.path.join(cachedir, name)
+
 	def save(self):
 		"save preferences to default location"
 		assert self.prefsfile
@@ -2854,6 +5690,46 @@ class Prefs(ConfigParser.RawConfigParser):
 		if maxtime < 1:
 			self.set('engines', 'maxtime', 1)
 
+		host = 0
+		try:
+			host = self.getint('engines', 'host')
+		except ConfigParser.NoSectionError:
+			self.add_section('engines')
+			self.set('engines', 'host', 0)
+		except ConfigParser.NoOptionError:
+			self.set('engines', 'host', 0)
+
+		processes = 2
+		try:
+			processes = self.getint('engines', 'processes')
+		except ConfigParser.NoSectionError:
+			self.add_section('engines')
+			self.set('engines', 'processes', 2)
+		except ConfigParser.NoOptionError:
+			self.set('engines', 'processes', 2)
+		if processes < 1:
+			self.set('engines', 'processes', 1)
+
+		analyses = 256
+		try:
+			analyses = self.getint('engines', 'analyses')
+		except ConfigParser.NoSectionError:
+			self.add_section('engines')
+			self.set('engines', 'analyses', 256)
+		except ConfigParser.NoOptionError:
+			self.set('engines', 'analyses', 256)
+		if analyses < 0:
+			self.set('engines', 'analyses', 0)
+
+		store = 0
+		try:
+			store = self.getint('engines', 'store')
+		except ConfigParser.NoSectionError:
+			self.add_section('engines')
+			self.set('engines', 'store', 0)
+		except ConfigParser.NoOptionError:
+			self.set('engines', 'store', 0)
+
 		# game
 		gametype = False
 		try:
@@ -2903,6 +5779,36 @@ class Prefs(ConfigParser.RawConfigParser):
 		if timeout < 100:
 			self.set('game', 'timeout', 100)
 
+		# book
+		lazy = 0
+		try:
+			lazy = self.getint('book', 'lazy')
+		except ConfigParser.NoSectionError:
+			self.add_section('book')
+			self.set('book', 'lazy', 0)
+		except ConfigParser.NoOptionError:
+			self.set('book', 'lazy', 0)
+
+		duplicates = 'keep'
+		try:
+			duplicates = self.get('book', 'duplicates')
+		except ConfigParser.NoSectionError:
+			self.add_section('book')
+			self.set('book', 'duplicates', 'keep')
+		except ConfigParser.NoOptionError:
+			self.set('book', 'duplicates', 'keep')
+		if duplicates not in ('keep', 'drop', 'merge'):
+			self.set('book', 'duplicates', 'keep')
+
+		recurring = 0
+		try:
+			recurring = self.getint('book', 'recurring')
+		except ConfigParser.NoSectionError:
+			self.add_section('book')
+			self.set('book', 'recurring', 0)
+		except ConfigParser.NoOptionError:
+			self.set('book', 'recurring', 0)
+
 		# look
 		scenefile = False
 		try:
@@ -2952,8 +5858,8 @@ class Fatal(gtk.Window):
 class Main:
 	"""create instances of the classes, map these to Main namespace
 
-	Position(), Game(), Book(), Prefs(), Players(), GladeGui(),
-	Feedback(), BookView(), CheckerBoard()
+	Position(), Game(), Rules(), Book(), Prefs(), Players(), Analyses(),
+	GladeGui(), Feedback(), BookView(), CheckerBoard()
 
 	is this a singleton?
 	"""
@@ -2964,9 +5870,13 @@ class Main:
 			Fatal('No threads in pygtk')
 		Main.pos = Position()
 		Main.game = Game()
+		Main.rules = Rules()
 		Main.book = Book()
 		Main.prefs = Prefs()
+		if Main.prefs.getint('engines', 'host'):
+			EngineHost.start() # fork, while there is no thread yet
 		Main.players = Players()
+		Main.analyses = Analyses()
 		Main.gui = GladeGui(Main.prefs.get('look', 'glade'))
 		Main.feedback = Main.gui['Feedback']
 		Main.feedback.prepare()
@@ -2976,13 +5886,10 @@ class Main:
 		if len(sys.argv) > 1:
 			fn = sys.argv[-1]
 			try:
-				f = open(fn, 'r')
+				f = PdnStream.open(fn)
 			except:
 				Fatal('No such file: %s' % fn)
-			pdn = Pdn(f, fn)
-			pdn.parse()
-			f.close()
-			del pdn
+			Main.gui.open_book(f, fn)
 		else:
 			Main.game.new()
 		gtk.main()